@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""compare the 'fetch' and 'stream' scanning engines of cooc-mutbamscan
+
+The 'fetch' engine performs one indexed query per distinct query window
+(amplicons sharing a window are evaluated on the same reads), and skips
+everything else, but reads overlapping neighbouring windows get decoded
+again by each. The 'stream' engine decodes every read once over the span
+of all windows. This benchmark scans the same synthetic BAM while varying
+the number of queried amplicons (spread out along the genome), to find the
+crossover point between both: with the ARTIC V3 scheme and the bundled
+voc/ definitions, around 20 amplicons (15 distinct windows).
+"""
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import click
+
+from cojac.cooc_mutbamscan import bed_load, make_all_amplicons, scanbam
+
+from synthetic import synthetic_bam
+
+
+def timed_scan(bam, amplicons, engine, repeat):
+    best = None
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            scanbam(bam, amplicons, None, engine=engine)
+            t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+@click.command(help="benchmark scanning engines against the number of amplicons")
+@click.option("-b", "--bedfile", default="nCoV-2019.insert.V3.bed", type=str)
+@click.option("-m", "--vocdir", default="voc", type=str)
+@click.option("--depth", default=200, type=int, help="read-pairs per amplicon")
+@click.option("--repeat", default=3, type=int)
+def bench_engines(bedfile, vocdir, depth, repeat):
+    vocs = [os.path.join(vocdir, p) for p in sorted(os.listdir(vocdir))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        all_amplicons = make_all_amplicons(bed_load(bedfile), vocs)
+
+    # spread-out subsets of the amplicons
+    names = list(all_amplicons.keys())
+    with tempfile.TemporaryDirectory() as tmp:
+        bam = os.path.join(tmp, "bench.bam")
+        synthetic_bam(bam, bedfile, all_amplicons, depth)
+        print("amplicons", "fetch/s", "stream/s", "ratio", sep="\t")
+        for k in sorted({1, 2, 5, 10, 20, 50, 100, 200, len(names)}):
+            if k > len(names):
+                continue
+            step = len(names) / k
+            amplicons = {
+                n: all_amplicons[n] for n in [names[int(i * step)] for i in range(k)]
+            }
+            t_fetch = timed_scan(bam, amplicons, "fetch", repeat)
+            t_stream = timed_scan(bam, amplicons, "stream", repeat)
+            print(
+                k,
+                f"{t_fetch:.3f}",
+                f"{t_stream:.3f}",
+                f"{t_fetch / t_stream:.2f}",
+                sep="\t",
+            )
+
+
+if __name__ == "__main__":
+    bench_engines()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""benchmark suite of cojac, to catch performance regressions between commits
+
+Times, on synthetic data (see synthetic.py):
+ - scanbam() with each engine, on alignments from 1k to 10M reads,
+ - make_all_amplicons() and scanbam() with 1 to 500 variant definitions
+   (random, or forming a lineage tree as generated by generate-sigs-nextstrains),
+ - cooc-tabmut on the results of many samples.
+
+Results are written as JSON, and can be compared with those of another commit.
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from cojac.cooc_mutbamscan import bed_load, make_all_amplicons, scanbam
+from cojac.cooc_tabmut import cooc_tabmut
+
+from synthetic import synthetic_bam, synthetic_lineages, synthetic_vocs
+
+
+def best_time(func, repeat):
+    """best wall time of repeated calls, output silenced"""
+    best = None
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            func()
+            t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def quiet(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def run_suite(bedfile, vocdir, reads_scales, vocs_scales, samples, repeat, tmp):
+    results = {}
+
+    def record(name, t):
+        results[name] = t
+        print(f"{name:<40}{t:10.4f}s", file=sys.stderr)
+
+    n_amp = len(bed_load(bedfile))
+    vocs = [os.path.join(vocdir, p) for p in sorted(os.listdir(vocdir))]
+    amplicons = quiet(make_all_amplicons, bed_load(bedfile), vocs)
+
+    # scanning at increasing depth
+    last_bam = None
+    for reads in reads_scales:
+        depth = max(1, reads // (2 * n_amp))
+        bam = os.path.join(tmp, f"reads{reads}.bam")
+        synthetic_bam(bam, bedfile, amplicons, depth)
+        for engine in ["fetch", "stream"]:
+            record(
+                f"scanbam/{engine}/reads={reads}",
+                best_time(lambda: scanbam(bam, amplicons, None, engine=engine), repeat),
+            )
+        last_bam = (reads, bam)
+
+    # compiling and scanning with an increasing number of variants
+    synth = synthetic_vocs(os.path.join(tmp, "vocs"), max(vocs_scales))
+    lineages = synthetic_lineages(os.path.join(tmp, "lineages"), max(vocs_scales))
+    reads, bam = min(
+        [(r, os.path.join(tmp, f"reads{r}.bam")) for r in reads_scales],
+        key=lambda rb: abs(rb[0] - 100000),
+    )
+    amp_bed = bed_load(bedfile)
+    for n in vocs_scales:
+        for name, defs in [("", synth), ("/lineages", lineages)]:
+            # without and with the subset fix (on by default: always pass it explicitly)
+            record(
+                f"make_all_amplicons{name}/vocs={n}",
+                best_time(
+                    lambda: make_all_amplicons(amp_bed, defs[:n], subset_fix=False),
+                    repeat,
+                ),
+            )
+            record(
+                f"make_all_amplicons{name}/subset_fix/vocs={n}",
+                best_time(
+                    lambda: make_all_amplicons(amp_bed, defs[:n], subset_fix=True),
+                    repeat,
+                ),
+            )
+        synth_amplicons = quiet(make_all_amplicons, amp_bed, synth[:n])
+        record(
+            f"scanbam/fetch/reads={reads}/vocs={n}",
+            best_time(lambda: scanbam(bam, synth_amplicons, None), repeat),
+        )
+
+    # tabulating many samples
+    result = quiet(scanbam, bam, amplicons, None)
+    table = os.path.join(tmp, "table.json")
+    with open(table, "wt") as jf:
+        json.dump({f"sample{i}": result for i in range(samples)}, jf)
+    for lines in [False, True]:
+        args = ["-j", table, "-o", os.path.join(tmp, "table.csv"), "-q"]
+        record(
+            f"cooc_tabmut/{'lines' if lines else 'wide'}/samples={samples}",
+            best_time(
+                lambda: cooc_tabmut.main(
+                    args + (["-l"] if lines else []), standalone_mode=False
+                ),
+                repeat,
+            ),
+        )
+
+    return results
+
+
+def compare(old, new, threshold):
+    """print the ratio of new vs old timings, returns the number of regressions"""
+    regressions = 0
+    print(f"{'benchmark':<40}{'old/s':>10}{'new/s':>10}{'ratio':>8}")
+    for name in new["results"]:
+        if name not in old["results"]:
+            continue
+        o = old["results"][name]
+        n = new["results"][name]
+        ratio = n / o if o else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = " REGRESSION"
+            regressions += 1
+        print(f"{name:<40}{o:10.4f}{n:10.4f}{ratio:8.2f}{flag}")
+    return regressions
+
+
+@click.command(
+    help="run the benchmark suite, and optionally compare with a previous run"
+)
+@click.option("-b", "--bedfile", default="../nCoV-2019.insert.V3.bed", type=str)
+@click.option("-m", "--vocdir", default="../voc", type=str)
+@click.option(
+    "--reads",
+    "reads_scales",
+    multiple=True,
+    type=int,
+    default=[1000, 10000, 100000],
+    help="number of reads of the synthetic alignments (use up to 10000000 for a full run)",
+)
+@click.option(
+    "--vocs",
+    "vocs_scales",
+    multiple=True,
+    type=int,
+    default=[1, 10, 50, 200, 500],
+    help="number of synthetic variants definitions",
+)
+@click.option("--samples", default=1000, type=int, help="samples for cooc-tabmut")
+@click.option("--repeat", default=3, type=int, help="keep the best of that many runs")
+@click.option("-o", "--output", metavar="JSON", default=None, help="save results")
+@click.option(
+    "-c",
+    "--compare",
+    "old_fname",
+    metavar="JSON",
+    default=None,
+    help="previous results",
+)
+@click.option(
+    "--threshold",
+    default=0.1,
+    type=float,
+    help="fraction slower than previous results considered a regression",
+)
+def bench_suite(
+    bedfile,
+    vocdir,
+    reads_scales,
+    vocs_scales,
+    samples,
+    repeat,
+    output,
+    old_fname,
+    threshold,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_suite(
+            bedfile, vocdir, reads_scales, vocs_scales, samples, repeat, tmp
+        )
+    new = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if output:
+        with open(output, "wt") as jf:
+            json.dump(new, jf, indent=1)
+    if old_fname:
+        with open(old_fname, "rt") as jf:
+            old = json.load(jf)
+        print(f"comparing {new['commit']} against {old.get('commit')}")
+        if compare(old, new, threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench_suite()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""synthetic amplicon alignments and variant definitions for benchmarking cojac
+
+Generates coordinate-sorted, indexed BAMs where read-pairs tile the amplicons
+of a BED file, carrying a set of mutations (substitutions and deletions) at a
+given frequency. Reads are written in coordinate order as they are generated,
+so even alignments with millions of reads never need to be held in memory.
+"""
+import os
+import random
+
+import numpy as np
+import pysam
+import yaml
+
+from cojac.cooc_mutbamscan import bed_load
+
+
+def random_reference(length=29903, seed=42):
+    rng = random.Random(seed)
+    return "".join(rng.choice("ACGT") for i in range(length))
+
+
+def haplotype_read(ref_seq, b, e, mutations):
+    """sequence and CIGAR of a read covering the reference [b, e), carrying mutations
+
+    Input:
+            mutations: dict() of 1-based position : bases or deletions ('-')
+    Returns:
+            (0-based start, sequence, cigartuples)
+    """
+    # per 0-based position: base, or None if deleted
+    bases = {}
+    for p, m in mutations.items():
+        for i, c in enumerate(m):
+            bases[p - 1 + i] = None if c == "-" else c
+
+    seq = []
+    ops = []
+    for x in range(b, e):
+        c = bases[x] if x in bases else ref_seq[x]
+        op = 2 if c is None else 0
+        if c is not None:
+            seq.append(c)
+        if len(ops) and ops[-1][0] == op:
+            ops[-1][1] += 1
+        else:
+            ops.append([op, 1])
+
+    # reads neither start nor end with a deletion
+    start = b
+    if ops[0][0] == 2:
+        start += ops.pop(0)[1]
+    if ops[-1][0] == 2:
+        ops.pop()
+    return (start, "".join(seq), [tuple(o) for o in ops])
+
+
+def tiled_reads(amp_bed, ref_seq, depth, mutations, mut_freq=0.5, read_len=150, seed=1):
+    """generate, in coordinate order, the read-pairs tiling each amplicon of the bed
+
+    Input:
+            amp_bed: pd.DataFrame from bed_load()
+            ref_seq: string of the reference
+            depth: number of read-pairs per amplicon
+            mutations: dict() of 1-based position : bases to plant
+            mut_freq: fraction of read-pairs carrying the mutations
+    Returns:
+            generator of (name, is_read1, start, cigartuples, sequence, mate start), with 0-based starts
+    """
+    rng = np.random.default_rng(seed)
+    # each event is a batch of reads sharing the same start
+    events = []
+    for i, (start, stop) in enumerate(zip(amp_bed["start"], amp_bed["stop"])):
+        start = int(start)
+        stop = min(int(stop), len(ref_seq))
+        r_len = min(read_len, stop - start)
+        amp_muts = {p: b for p, b in mutations.items() if start < p <= stop - len(b)}
+        mutated = rng.random(depth) < mut_freq
+        for mut in [False, True]:
+            names = [f"amp{i}_{n}" for n in np.flatnonzero(mutated == mut)]
+            if not len(names):
+                continue
+            muts = amp_muts if mut else {}
+            r1 = haplotype_read(ref_seq, start, start + r_len, muts)
+            r2 = haplotype_read(ref_seq, stop - r_len, stop, muts)
+            events.append((r1[0], names, True, r1, r2[0]))
+            events.append((r2[0], names, False, r2, r1[0]))
+    events.sort(key=lambda e: e[0])
+
+    for pos, names, is_read1, (start, seq, cigar), mate_start in events:
+        for name in names:
+            yield (name, is_read1, start, cigar, seq, mate_start)
+
+
+def write_synthetic_bam(fname, reads, ref_name="NC_045512.2", ref_len=29903):
+    """write (and index) a coordinate-sorted BAM from tiled_reads() output
+
+    Returns:
+            the number of reads written
+    """
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": ref_name, "LN": ref_len}],
+    }
+    n = 0
+    with pysam.AlignmentFile(fname, "wb", header=header) as out:
+        for name, is_read1, start, cigar, seq, mate_start in reads:
+            a = pysam.AlignedSegment(out.header)
+            a.query_name = name
+            a.query_sequence = seq
+            a.flag = 0x1 | 0x2 | (0x40 | 0x20 if is_read1 else 0x80 | 0x10)
+            a.reference_id = 0
+            a.reference_start = start
+            a.next_reference_id = 0
+            a.next_reference_start = mate_start
+            a.mapping_quality = 60
+            a.cigartuples = cigar
+            out.write(a)
+            n += 1
+    pysam.index(fname)
+    return n
+
+
+def amplicon_mutations(amplicons):
+    """all the mutations searched by an amplicon query"""
+    return {int(p): m for amp in amplicons.values() for p, m in amp[4].items()}
+
+
+def synthetic_bam(fname, bedfile, mutations, depth, mut_freq=0.5, seed=1):
+    """shortcut: tile the bed at depth, planting the mutations
+
+    mutations: either a dict() of position : bases, or an amplicon query (see amplicon_mutations())
+
+    Returns:
+            the number of reads written
+    """
+    if len(mutations) and isinstance(next(iter(mutations.values())), list):
+        mutations = amplicon_mutations(mutations)
+    return write_synthetic_bam(
+        fname,
+        tiled_reads(
+            bed_load(bedfile),
+            random_reference(),
+            depth,
+            mutations,
+            mut_freq=mut_freq,
+            seed=seed,
+        ),
+    )
+
+
+def synthetic_vocs(vocdir, n_vocs, n_muts=40, pool_size=600, seed=1):
+    """write n_vocs variant definitions YAMLs with random mutations
+
+    Mutations are drawn from a common pool, so that variants share mutations
+    (and amplicons get merged or are subsets of each others) as with real ones.
+
+    Returns:
+            list of the YAMLs written
+    """
+    rng = random.Random(seed)
+    ref_seq = random_reference()
+    pool = {}
+    while len(pool) < pool_size:
+        p = rng.randint(100, len(ref_seq) - 100)
+        if rng.random() < 0.1:
+            pool[p] = "-" * rng.randint(1, 9)
+        else:
+            pool[p] = (
+                f"{ref_seq[p - 1]}>{rng.choice('ACGT'.replace(ref_seq[p - 1], ''))}"
+            )
+    positions = sorted(pool.keys())
+
+    os.makedirs(vocdir, exist_ok=True)
+    fnames = []
+    for v in range(n_vocs):
+        muts = sorted(rng.sample(positions, n_muts))
+        fname = os.path.join(vocdir, f"synth{v}_mutations.yaml")
+        with open(fname, "wt") as yf:
+            yaml.dump(
+                {
+                    "variant": {"short": f"s{v}", "pangolin": f"X.{v}"},
+                    "mut": {p: pool[p] for p in muts},
+                },
+                yf,
+                sort_keys=False,
+            )
+        fnames.append(fname)
+    return fnames
+
+
+def synthetic_lineages(vocdir, n_vocs, n_new=3, pool_size=600, seed=1):
+    """write n_vocs variant definitions YAMLs forming a lineage tree
+
+    As with signatures generated per lineage (see generate-sigs-nextstrains),
+    each lineage carries the mutations of its parent plus n_new of its own,
+    so that many amplicons are identical or subsets of each others.
+
+    Returns:
+            list of the YAMLs written
+    """
+    rng = random.Random(seed)
+    ref_seq = random_reference()
+    positions = sorted(rng.sample(range(100, len(ref_seq) - 100), pool_size))
+
+    os.makedirs(vocdir, exist_ok=True)
+    fnames = []
+    lineages = []
+    for v in range(n_vocs):
+        muts = set(lineages[rng.randrange(v)]) if v else set()
+        muts.update(rng.sample(positions, n_new))
+        lineages.append(muts)
+        fname = os.path.join(vocdir, f"lineage{v}_mutations.yaml")
+        with open(fname, "wt") as yf:
+            yaml.dump(
+                {
+                    "variant": {"short": f"l{v}", "pangolin": f"L.{v}"},
+                    "mut": {
+                        p: f"{ref_seq[p - 1]}>{'T' if ref_seq[p - 1] != 'T' else 'G'}"
+                        for p in sorted(muts)
+                    },
+                },
+                yf,
+                sort_keys=False,
+            )
+        fnames.append(fname)
+    return fnames
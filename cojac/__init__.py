@@ -1,6 +1,8 @@
 from .main import cli
+from .cooc_cache import cooc_cache
 from .cooc_colourmut import cooc_colourmut
 from .cooc_curate import cooc_curate
+from .cooc_merge import cooc_merge
 from .cooc_mutbamscan import cooc_mutbamscan
 from .cooc_pubmut import cooc_pubmut
 from .cooc_tabmut import cooc_tabmut
@@ -9,8 +11,10 @@ from ._version import __version__
 
 __all__ = [
     "cli",
+    "cooc_cache",
     "cooc_colourmut",
     "cooc_curate",
+    "cooc_merge",
     "cooc_mutbamscan",
     "cooc_pubmut",
     "cooc_tabmut",
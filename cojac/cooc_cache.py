@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import glob
+import hashlib
+import json
+
+import click
+
+
+def index_fname(alnfname):
+    """find the index of an alignment file (if any)"""
+    base = os.path.splitext(alnfname)[0]
+    for idx in [
+        f"{alnfname}.bai",
+        f"{alnfname}.csi",
+        f"{alnfname}.crai",
+        f"{base}.bai",
+        f"{base}.csi",
+        f"{base}.crai",
+    ]:
+        if os.path.isfile(idx):
+            return idx
+    return None
+
+
+def file_checksum(fname):
+    """sha256 of a (small) file"""
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def alignment_identity(alnfname):
+    """identity of an alignment file: path, size, modification time, and checksum of its index"""
+    st = os.stat(alnfname)
+    idx = index_fname(alnfname)
+    return {
+        "path": os.path.realpath(alnfname),
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "index": file_checksum(idx) if idx else None,
+    }
+
+
+def restore_amplicon(amp):
+    """JSON only has string keys: restore the integer keys of the sites/muts histograms of an amplicon"""
+    if "sites" not in amp:
+        # split by groups (see scanbam()'s split_tag)
+        return {group: restore_amplicon(res) for group, res in amp.items()}
+    return {
+        k: ({int(c): n for c, n in v.items()} if k in ("sites", "muts") else v)
+        for k, v in amp.items()
+    }
+
+
+def restore_result(result):
+    """JSON only has string keys: restore the integer keys of the sites/muts histograms"""
+    return {amp_key: restore_amplicon(amp) for amp_key, amp in result.items()}
+
+
+def atomic_json(obj, fname):
+    """write a JSON file atomically (concurrent jobs can share the cache)"""
+    tmpname = f"{fname}.{os.getpid()}.tmp"
+    with open(tmpname, "wt") as jf:
+        json.dump(obj=obj, fp=jf)
+    os.replace(tmpname, fname)
+
+
+class ScanCache:
+    """on-disk cache of scanbam() results
+
+    Entries are keyed by the identity of the alignment file (see
+    alignment_identity()) combined with the scanning parameters that
+    influence the results. Each entry holds the results of the amplicons
+    scanned so far in that file, indexed by amplicon definition. Hits are
+    returned without opening the alignment file. The cache is kept under
+    max_size bytes by evicting the least recently used entries, once per run
+    (see evict(): it lists the whole cache, which is slow on network filesystems).
+
+    hits and misses count amplicon definitions, they are updated by the caller.
+    """
+
+    def __init__(self, cachedir, max_size=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        os.makedirs(os.path.join(cachedir, "objects"), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, alnfname, params={}):
+        """cache key of the scans of an alignment file"""
+        return hashlib.sha256(
+            json.dumps(
+                {
+                    "alignment": alignment_identity(alnfname),
+                    "params": params,
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, "objects", key[:2], f"{key}.json")
+
+    def get(self, key):
+        """return the stored result or None"""
+        fname = self.path(key)
+        try:
+            with open(fname, "rt") as jf:
+                result = json.load(fp=jf)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # LRU: keep track of last use with the modification time
+        os.utime(fname)
+        return restore_result(result)
+
+    def put(self, key, result):
+        """store a result (call evict() once done storing)"""
+        fname = self.path(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        atomic_json(result, fname)
+
+    def entries(self):
+        """list of (last use, size, file) of all entries"""
+        entries = []
+        for fname in glob.glob(os.path.join(self.cachedir, "objects", "*", "*.json")):
+            try:
+                st = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, fname))
+        return entries
+
+    def evict(self):
+        """remove least recently used entries until the cache fits max_size"""
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """cumulated statistics of all runs using this cache"""
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        fname = os.path.join(self.cachedir, "stats.json")
+        if os.path.isfile(fname):
+            with open(fname, "rt") as jf:
+                stats.update(json.load(fp=jf))
+        return stats
+
+    def save_stats(self):
+        """add this run's counters to the statistics stored in the cache"""
+        stats = self.stats()
+        stats["hits"] += self.hits
+        stats["misses"] += self.misses
+        stats["evictions"] += self.evictions
+        atomic_json(stats, os.path.join(self.cachedir, "stats.json"))
+        self.hits = self.misses = self.evictions = 0
+        return stats
+
+
+@click.command(
+    help="Report statistics of the cooc-mutbamscan result cache",
+    epilog="See the --cache option of cooc-mutbamscan",
+)
+@click.argument("cachedir", metavar="DIR", type=click.Path(exists=True))
+@click.option(
+    "--clear",
+    is_flag=True,
+    default=False,
+    help="remove all entries and statistics from the cache",
+)
+def cooc_cache(cachedir, clear):
+    cache = ScanCache(cachedir)
+    if clear:
+        for mtime, size, fname in cache.entries():
+            os.remove(fname)
+        statsfname = os.path.join(cachedir, "stats.json")
+        if os.path.isfile(statsfname):
+            os.remove(statsfname)
+
+    entries = cache.entries()
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    print(f"entries:\t{len(entries)}")
+    print(f"size:\t{sum(e[1] for e in entries)}")
+    # counted per amplicon definition
+    print(f"amplicon hits:\t{stats['hits']}")
+    print(f"amplicon misses:\t{stats['misses']}")
+    print(f"evictions:\t{stats['evictions']}")
+    print(
+        f"hit rate:\t{100 * stats['hits'] / lookups:.2f}%"
+        if lookups
+        else "hit rate:\tNA"
+    )
+
+
+if __name__ == "__main__":
+    cooc_cache()
@@ -6,6 +6,13 @@ import yaml
 
 import click
 
+from .cooc_mutbamscan import (
+    columnar_results,
+    iter_jsonl,
+    query_key,
+    read_columnar,
+)
+
 
 @click.command(
     help="Print coloured pretty table on terminal",
@@ -37,7 +44,21 @@ import click
     type=str,
     help="results generated by mutbamscan",
 )
-def cooc_colourmut(amp, json_fname, yaml_fname):
+@click.option(
+    "--jsonl",
+    "jsonl_fname",
+    metavar="JSONL",
+    type=str,
+    help="results generated by mutbamscan --jsonl (read one sample at a time)",
+)
+@click.option(
+    "--columnar",
+    "columnar_fname",
+    metavar="PARQUET/ARROW",
+    type=str,
+    help="results table generated by mutbamscan --columnar or tabmut (Parquet or Arrow IPC)",
+)
+def cooc_colourmut(amp, json_fname, yaml_fname, jsonl_fname, columnar_fname):
     # load table
     table = {}
 
@@ -49,6 +70,19 @@ def cooc_colourmut(amp, json_fname, yaml_fname):
         assert os.path.isfile(yaml_fname), f"cannot find result yaml file {yaml_fname}"
         with open(yaml_fname, "rt") as yf:
             table = yaml.safe_load(yf)
+    elif jsonl_fname:
+        assert os.path.isfile(
+            jsonl_fname
+        ), f"cannot find result jsonl file {jsonl_fname}"
+        # JSON Lines are read one sample at a time, instead of loading the whole table:
+        # a first pass only to get the samples names (for the column width)
+        table = {sam: None for sam, amplicons in iter_jsonl(jsonl_fname)}
+    elif columnar_fname:
+        assert os.path.isfile(
+            columnar_fname
+        ), f"cannot find result table file {columnar_fname}"
+        table = dict(columnar_results(read_columnar(columnar_fname)))
+    table.pop(query_key, None)  # see mutbamscan --partial
 
     assert len(table) > 0, "cannot succesfully load table"
 
@@ -95,7 +129,10 @@ def cooc_colourmut(amp, json_fname, yaml_fname):
         print(f"{'cov:' :>9}{'mut:' :>9}{'frq/%:' :>9}", end="")
     print()
 
-    for sam, amplicons in table.items():
+    samples = iter_jsonl(jsonl_fname) if jsonl_fname else table.items()
+    for sam, amplicons in samples:
+        if sam == query_key:
+            continue
         print(f"{sam :>{l}} ", end="")
 
         for (
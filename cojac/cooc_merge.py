@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import os
+import glob
+import json
+import yaml
+
+import click
+
+from .cooc_mutbamscan import iter_jsonl, query_key
+
+
+def expand_inputs(inputs):
+    """expand the glob patterns among a list of input files (shells may leave them as-is)"""
+    fnames = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern))
+        assert len(matches) or os.path.isfile(
+            pattern
+        ), f"cannot find result file {pattern}"
+        fnames += matches or [pattern]
+    return fnames
+
+
+def load_partial(fname):
+    """load a (partial) result file
+
+    Returns:
+            tuple of (amplicon query info or None, iterable of (sample, results))
+    """
+    if fname.endswith((".jsonl", ".jsonl.gz")):
+        # header first, then one sample at a time
+        records = iter_jsonl(fname)
+        (key, query) = next(records, (None, None))
+        return (query, records) if key == query_key else (None, [])
+    with open(fname, "rt") as f:
+        if fname.endswith((".yaml", ".yml")):
+            table = yaml.safe_load(f)
+        else:
+            table = json.load(fp=f)
+    query = table.pop(query_key, None) if table else None
+    return (query, (table or {}).items())
+
+
+@click.command(
+    help="Merge the partial results of multiple cooc-mutbamscan runs into a single result file",
+    epilog="Inputs are read one at a time, so that the whole cohort is never loaded in memory. They must have been written with --partial, --shard or --jsonl, and the same amplicon query.",
+)
+@click.option(
+    "-j",
+    "--json",
+    "json_fname",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=str,
+    help="output merged results to a JSON file",
+)
+@click.option(
+    "-y",
+    "--yaml",
+    "yaml_fname",
+    metavar="YAML",
+    required=False,
+    default=None,
+    type=str,
+    help="output merged results to a yaml file",
+)
+@click.option(
+    "--partial",
+    is_flag=True,
+    default=False,
+    help="keep the hash of the amplicon query in the output, to merge it again later",
+)
+@click.argument("inputs", metavar="JSON/YAML/JSONL...", nargs=-1, required=True)
+def cooc_merge(json_fname, yaml_fname, partial, inputs):
+    assert (
+        json_fname or yaml_fname
+    ), "Neither -j/--json nor -y/--yaml provided. Please provide an output file"
+    assert not (
+        json_fname and yaml_fname
+    ), "Please provide only one of -j/--json or -y/--yaml"
+    out_fname = json_fname or yaml_fname
+
+    seen = set()
+    query = None
+    with open(out_fname, "wt") as of:
+        first = True
+
+        def write(sample, result):
+            nonlocal first
+            if json_fname:
+                # same layout as json.dump() of the whole table
+                of.write(
+                    ("{" if first else ", ")
+                    + json.dumps(sample)
+                    + ": "
+                    + json.dumps(result)
+                )
+            else:
+                of.write(yaml.dump({sample: result}, sort_keys=False))
+            first = False
+
+        for fname in expand_inputs(inputs):
+            (q, table) = load_partial(fname)
+            assert (
+                q is not None
+            ), f"Error: {fname} has no amplicon query hash, was it written with cooc-mutbamscan --partial or --jsonl?"
+            if query is None:
+                query = q
+                if partial:
+                    write(query_key, query)
+            assert (
+                q["hash"] == query["hash"]
+            ), f"Error: {fname} was scanned with a different amplicon query than the previous files"
+
+            n = 0
+            for sample, result in table:
+                assert (
+                    sample not in seen
+                ), f"Error: sample {sample} found again in {fname}"
+                seen.add(sample)
+                write(sample, result)
+                n += 1
+            print(f"{fname}: {n} samples")
+
+        if json_fname:
+            of.write("{}" if first else "}")
+    print(f"merged {len(seen)} samples")
+
+
+if __name__ == "__main__":
+    cooc_merge()
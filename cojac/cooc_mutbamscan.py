@@ -8,12 +8,23 @@ import csv
 import json
 import yaml
 import gzip
+import bisect
+import array
+import collections
+import functools
+import hashlib
+import heapq
+import zlib
+import contextlib
+import time
+import resource
 
 # import pysam # HACK pysam isn't available on bioconda aarch64, yet. But loading it here cause every other function of cojac to fail, too.
 
 import click
 
 from .mut_parser import mut_decode, filter_decode_vartiant
+from .cooc_cache import ScanCache, restore_result
 
 
 def test_read(read, mut_dict):
@@ -62,60 +73,559 @@ def test_read(read, mut_dict):
         return (found_site, None)
 
 
-# scan an amplicon for a specific set of mutations
-def scanamplicon(read_iter, mut_dict):
-    # TODO inefficient, could be streamed (with an accumulator for pairs)
-    reads = dict()
-    for read in read_iter:
+def aligned_blocks(read):
+    """walk the CIGAR of a pysam read to list its aligned blocks
+
+    Returns:
+            three lists with, for each aligned block (CIGAR M, = or X):
+            0-based reference start, reference end, and offset in the query sequence
+    """
+    starts = []
+    ends = []
+    offsets = []
+    r = read.reference_start
+    q = 0
+    for op, l in read.cigartuples:
+        if op == 0 or op == 7 or op == 8:  # M, =, X: consume both
+            starts.append(r)
+            ends.append(r + l)
+            offsets.append(q)
+            r += l
+            q += l
+        elif op == 2 or op == 3:  # D, N: consume reference
+            r += l
+        elif op == 1 or op == 4:  # I, S: consume query
+            q += l
+        # H, P: consume nothing
+    return (starts, ends, offsets)
+
+
+SiteIndex = collections.namedtuple(
+    "SiteIndex", ["keys", "positions", "mutations", "minlen", "maxlen"]
+)
+SiteIndex.__doc__ = """mutation sites of an amplicon, compiled for fast look-ups
+
+    keys:		positions as in the mut_dict (1-based)
+    positions:	sorted 0-based positions
+    mutations:	bases or deletions at each of those positions
+    minlen, maxlen:	shortest and longest mutation
+"""
+
+
+def compile_sites(mut_dict):
+    """compile the mut_dict of an amplicon into a SiteIndex sorted by position"""
+    items = sorted(mut_dict.items(), key=lambda pm: int(pm[0]))
+    return SiteIndex(
+        keys=[p for p, m in items],
+        positions=[int(p) - 1 for p, m in items],
+        mutations=[m for p, m in items],
+        minlen=min([len(m) for p, m in items], default=0),
+        maxlen=max([len(m) for p, m in items], default=0),
+    )
+
+
+def test_read_mask(read, sites):
+    """
+    test if mutations listed in a SiteIndex (see compile_sites()) are present in the pysam read
+
+    Same tests as test_read(), but:
+     - sites covered by the read are selected by a range query on the sorted
+       positions, so the cost grows with the number of sites the read covers
+       instead of the size of the amplicon definition,
+     - goes straight from each mutation position to its offset in the query by
+       walking the read's CIGAR, instead of building a dictionary of every single
+       aligned base of the read.
+
+    Each site of the SiteIndex is given a fixed bit: its rank in the sorted positions.
+
+    returns a list with:
+            site_mask:	bitmask of the sites present in the read (no matter content)
+            mut_mask:	bitmask of those sites which have the mutations variant
+    """
+
+    # WARNING pysam is 0-based! (see here: https://pysam.readthedocs.io/en/latest/faq.html#pysam-coordinates-are-wrong )
+    ref_start = read.reference_start
+    ref_end = read.reference_end
+    if ref_end is None:
+        return (0, 0)  # unmapped: no sites
+
+    # 1. check which mutation' sites are in range of that read
+    positions = sites.positions
+    lo = bisect.bisect_left(positions, ref_start)
+    hi = bisect.bisect_right(positions, ref_end - sites.minlen)
+    if sites.maxlen != sites.minlen:
+        # longer mutations must still fit entirely
+        found = [
+            i
+            for i in range(lo, hi)
+            if positions[i] <= ref_end - len(sites.mutations[i])
+        ]
+    else:
+        found = range(lo, hi)
+    if not len(found):
+        return (0, 0)  # sites aren't present no point checking variants
+
+    # 2. of those sites, check which content mutations' variants
+    (starts, ends, offsets) = aligned_blocks(read)
+    seq = read.query_sequence
+
+    site_mask = 0
+    mut_mask = 0
+    for s in found:
+        site_mask |= 1 << s
+        q = positions[s]
+        m = sites.mutations[s]
+        present = 0
+        matching = True
+        for i in range(len(m)):
+            x = q + i
+            b = bisect.bisect_right(starts, x) - 1
+            if b >= 0 and x < ends[b]:  # base present
+                present += 1
+                if seq[offsets[b] + x - starts[b]] != m[i]:
+                    matching = False
+        if present == len(m):  # all positions found!
+            # check if it's the expected mutation(s)
+            if matching:
+                mut_mask |= 1 << s
+        elif present == 0:  # none position found! (entire deletion)
+            # check if we're hunting for a string of deletions (-)
+            if "-" * len(m) == m:
+                mut_mask |= 1 << s
+        # TODO give some thoughs about partial deletions
+
+    return (site_mask, mut_mask)
+
+
+def mask_keys(mask, sites):
+    """positions (as in the mut_dict) of the bits set in a mask of a SiteIndex"""
+    return [k for i, k in enumerate(sites.keys) if mask >> i & 1]
+
+
+def test_read_cigar(read, sites):
+    """
+    same as test_read_mask(), but with the same return values as test_read():
+
+    returns a list with:
+            found_site:	list of site present in the read (no matter content)
+            found_mut:	list of those position which have the mutations variant
+    """
+    (site_mask, mut_mask) = test_read_mask(read, sites)
+    return (
+        mask_keys(site_mask, sites) if site_mask else None,
+        mask_keys(mut_mask, sites) if mut_mask else None,
+    )
+
+
+# number of bits set in a mask (int.bit_count() is only available since python 3.10)
+popcount = getattr(int, "bit_count", lambda mask: bin(mask).count("1"))
+
+
+def histogram(counts):
+    """values and number of occurrences of an array('H') of counts (like np.unique)"""
+    bins = np.bincount(np.frombuffer(counts, dtype=np.uint16))
+    values = np.flatnonzero(bins)
+    return (values, bins[values])
+
+
+def name_rank(name):
+    """pseudo-random rank in [0, 1) of a read-pair, given its query name"""
+    return zlib.crc32(name.encode()) / 0x100000000
+
+
+def binomial_ci_width(x, n, z=1.96):
+    """width of the Wilson score interval of a x/n binomial proportion (default: 95%)"""
+    p = x / n
+    return 2 * z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+
+
+class PairAccumulator:
+    """streaming accumulator of read-pairs for an amplicon
+
+    Reads from a coordinate-sorted stream are tested with test_read_mask() as
+    soon as they arrive. Only the compact results (bitmasks of the found sites
+    and mutations) are kept, and only for as long as the mate is still expected further in the
+    stream: the mate's position and flags tell whether it has already passed
+    or will never show up in the query window. Peak memory thus depends on
+    the number of pending mates instead of the amplicon's depth.
+
+    Only primary alignments are evaluated: secondary and supplementary
+    alignments (flag 0x900) are skipped by all engines. (They can show up
+    after their pair has already been retired, which would count it twice.)
+
+    Optionally, deep amplicons can be subsampled:
+      max_pairs: only keep a uniform sample of that many pairs covering
+            sites. Pairs are ranked by a hash of their query name (so both
+            mates are always kept or dropped together) and the max_pairs
+            lowest are kept (bottom-k sampling): once the sample is full,
+            reads ranking above it are dropped before being evaluated.
+      ci_width: only keep the smallest such sample (the pairs ranking lowest)
+            for which the 95% (Wilson) confidence interval of the fraction of
+            pairs carrying mutations among pairs covering sites is narrower
+            than ci_width. The interval is the widest for a fraction of 1/2,
+            where (1.96 / ci_width)^2 pairs are always enough: this caps the
+            sample (like max_pairs) while reading. Once the whole window has
+            been read, the sample is trimmed down to the smallest prefix
+            narrow enough for the fraction actually found. (Pairs arrive
+            sorted by position, which may correlate with their content, e.g.:
+            pairs with shorter inserts complete first, so stopping at the
+            first pairs would not give a uniform sample.)
+
+    haplotypes: also count every pattern of sites and mutations observed on
+            the pairs. Results then have an extra 'haplotypes' entry with the
+            'positions' of the mut_dict (sorted) and the 'patterns' counts, each
+            pattern having one character per position: '1' mutation found,
+            '0' site covered without the mutation, '.' site not covered.
+            e.g.: with positions [22917, 22995], '10' counts the pairs with
+            22917's mutation but without 22995's.
+    """
+
+    # minimum number of pairs covering sites before considering stopping
+    ci_min_pairs = 30
+
+    def __init__(
+        self,
+        mut_dict,
+        rq_b=None,
+        rq_e=None,
+        max_pairs=None,
+        ci_width=None,
+        haplotypes=False,
+    ):
+        self.mut_dict = mut_dict
+        self.site_index = compile_sites(mut_dict)
+        self.rq_b = rq_b
+        self.rq_e = rq_e
+        # query name : (R1/R2, site_mask, mut_mask) of pairs still waiting for their mate
+        self.pending = {}
+        self.peak_pending = 0
+        self.reads = 0
+        self.pairs = 0
+        # number of distinct sites and mutations found on each pair
+        self.sites = array.array("H")
+        self.muts = array.array("H")
+        # (site_mask, mut_mask) : number of pairs
+        self.patterns = collections.Counter() if haplotypes else None
+        # subsampling
+        self.max_pairs = max_pairs
+        self.ci_width = ci_width
+        self.sampling = max_pairs is not None or ci_width is not None
+        self.cap = max_pairs  # size of the bottom-k sample
+        self.cap_stop = "max_pairs"
+        if ci_width is not None:
+            # enough pairs for any fraction (the interval is the widest at 1/2)
+            ci_pairs = max(self.ci_min_pairs, int(np.ceil((1.96 / ci_width) ** 2)))
+            if self.cap is None or ci_pairs < self.cap:
+                self.cap = ci_pairs
+                self.cap_stop = "ci_width"
+        self.threshold = 1.0  # only pairs whose name hashes below are kept
+        self.kept = []  # heap of (-hash, site_mask, mut_mask) of the kept pairs
+        self.stop = None
+
+    def mate_pending(self, read):
+        """check if the mate of a read is still to come in the coordinate-sorted stream"""
+        if (
+            (not read.is_paired)
+            or read.mate_is_unmapped
+            or read.next_reference_id != read.reference_id
+        ):
+            return False
+        if read.next_reference_start < read.reference_start:
+            # mate already passed: it would be in pending if it was in the window
+            return False
+        # mate could still overlap the query window
+        return self.rq_e is None or read.next_reference_start < self.rq_e
+
+    def add(self, read):
+        """test one read and pair it with its mate"""
+        self.reads += 1
+        if read.is_secondary or read.is_supplementary:
+            return
         name = str(read.query_name)
+        if self.sampling and name_rank(name) >= self.threshold:
+            # not part of the sample
+            return
         R = "R1" if read.is_read1 else "R2"
-        if name in reads:
-            reads[name][R] = read
+        (site_mask, mut_mask) = test_read_mask(read, self.site_index)
+
+        if name in self.pending:
+            (R_p, site_p, mut_p) = self.pending[name]
+            if R_p == R:
+                # another alignment of the same end: replaces it
+                self.pending[name] = (R, site_mask, mut_mask)
+            else:
+                # both ends seen
+                del self.pending[name]
+                self.retire(site_p | site_mask, mut_p | mut_mask, name)
+        elif self.mate_pending(read):
+            self.pending[name] = (R, site_mask, mut_mask)
+            if len(self.pending) > self.peak_pending:
+                self.peak_pending = len(self.pending)
         else:
-            reads[name] = {R: read}
-
-    print("amplion:", len(reads))
-
-    # tally the mutation sites and the presence of variant in there accross all reads
-    # TODO merge with above
-    all_muts = []
-    all_sites = []
-    for rds in reads:
-        val = reads[rds]
-        site_out = []
-        mut_out = []
-        for s in val:
-            R = val[s]
-            (t_pos, t_read) = test_read(R, mut_dict)
-            if t_pos is not None:
-                site_out.extend(t_pos)
-            if t_read is not None:
-                mut_out.extend(t_read)
-        if len(site_out):
-            all_sites.append(site_out)
-            if len(mut_out):
-                all_muts.append(mut_out)
-
-    sites_cnt = np.unique([len(set(mut)) for mut in all_sites], return_counts=True)
-    print("sites:", len(all_sites), sites_cnt)
-    muts_cnt = np.unique([len(set(sit)) for sit in all_muts], return_counts=True)
-    print("muts:", len(all_muts), muts_cnt)
-
-    # look at last column only
+            self.retire(site_mask, mut_mask, name)
+
+    def add_pair(self, reads):
+        """test all the reads of a pair at once (e.g.: from a name-collated stream)"""
+        self.reads += len(reads)
+        reads = [r for r in reads if not (r.is_secondary or r.is_supplementary)]
+        if not len(reads):
+            return
+        name = str(reads[0].query_name)
+        if self.sampling and name_rank(name) >= self.threshold:
+            return
+        # (as in add(): another alignment of the same end replaces it)
+        ends = {}
+        for read in reads:
+            ends["R1" if read.is_read1 else "R2"] = test_read_mask(
+                read, self.site_index
+            )
+        site_mask = 0
+        mut_mask = 0
+        for s, m in ends.values():
+            site_mask |= s
+            mut_mask |= m
+        self.retire(site_mask, mut_mask, name)
+
+    def retire(self, site_mask, mut_mask, name=None):
+        """tally the mutation sites and the presence of variant of a finished pair"""
+        self.pairs += 1
+        if self.sampling:
+            self.sample(name, site_mask, mut_mask)
+        elif site_mask:
+            self.tally(site_mask, mut_mask)
+
+    def tally(self, site_mask, mut_mask):
+        """count a pair covering sites"""
+        self.sites.append(popcount(site_mask))
+        if mut_mask:
+            self.muts.append(popcount(mut_mask))
+        if self.patterns is not None:
+            self.patterns[(site_mask, mut_mask)] += 1
+
+    def sample(self, name, site_mask, mut_mask):
+        """add a finished pair covering sites to the sample, and keep it under the cap"""
+        u = name_rank(name)
+        if u >= self.threshold or not site_mask:
+            # the sample got filled with lower ranking pairs in the meantime
+            # (or nothing to count)
+            return
+        heapq.heappush(self.kept, (-u, site_mask, mut_mask))
+        if self.cap is not None and len(self.kept) > self.cap:
+            (u, site_mask, mut_mask) = heapq.heappop(self.kept)
+            self.threshold = -u
+            self.stop = self.cap_stop
+
+    def narrow(self):
+        """only keep the smallest sample whose confidence interval is narrow enough"""
+        ranked = sorted(self.kept, reverse=True)  # lowest hash first
+        n_muts = 0
+        for i, (u, site_mask, mut_mask) in enumerate(ranked):
+            n_muts += mut_mask != 0
+            if (
+                i + 1 < len(ranked)
+                and i + 1 >= self.ci_min_pairs
+                and binomial_ci_width(n_muts, i + 1) < self.ci_width
+            ):
+                # only keep the pairs ranking below the next one
+                self.threshold = -ranked[i + 1][0]
+                self.kept = ranked[: i + 1]
+                # (if nothing was dropped while reading, the work wasn't reduced)
+                self.stop = "ci_width" if self.stop is not None else "ci_width_trim"
+                return
+
+    def finish(self):
+        """flush pairs whose mate never showed up and return the histograms"""
+        for name, (R, site_mask, mut_mask) in self.pending.items():
+            self.retire(site_mask, mut_mask, name)
+        self.pending = {}
+        if self.ci_width is not None:
+            self.narrow()
+        if self.sampling:
+            for u, site_mask, mut_mask in self.kept:
+                self.tally(site_mask, mut_mask)
+
+        print("amplion:", self.pairs)
+
+        sites_cnt = histogram(self.sites)
+        print("sites:", len(self.sites), sites_cnt)
+        muts_cnt = histogram(self.muts)
+        print("muts:", len(self.muts), muts_cnt)
+
+        # look at last column only
+        return {
+            "sites": (
+                dict(zip(sites_cnt[0].tolist(), sites_cnt[1].tolist()))
+                if len(self.sites)
+                else {}
+            ),
+            "muts": (
+                dict(zip(muts_cnt[0].tolist(), muts_cnt[1].tolist()))
+                if len(self.muts)
+                else {}
+            ),
+            **(
+                {"subsampled": {"pairs": len(self.kept), "stop": self.stop}}
+                if self.stop is not None
+                else {}
+            ),
+            **({"haplotypes": self.haplotypes()} if self.patterns is not None else {}),
+        }
+
+    def haplotypes(self):
+        """counts of the site/mutation patterns (see class documentation)"""
+        n = len(self.site_index.keys)
+        patterns = {}
+        for (site_mask, mut_mask), cnt in self.patterns.most_common():
+            patterns[
+                "".join(
+                    (("1" if mut_mask >> i & 1 else "0") if site_mask >> i & 1 else ".")
+                    for i in range(n)
+                )
+            ] = cnt
+        # (positions may be numpy integers, e.g.: loaded with -Q)
+        return {
+            "positions": [int(p) for p in self.site_index.keys],
+            "patterns": patterns,
+        }
+
+
+class TimedPairAccumulator(PairAccumulator):
+    """PairAccumulator which also measures the time spent evaluating reads (for profiling)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.time = 0.0
+
+    def add(self, read):
+        t = time.perf_counter()
+        super().add(read)
+        self.time += time.perf_counter() - t
+
+    def add_pair(self, reads):
+        t = time.perf_counter()
+        super().add_pair(reads)
+        self.time += time.perf_counter() - t
+
+    def profile(self):
+        """statistics of this amplicon"""
+        return {
+            "window": [int(self.rq_b), int(self.rq_e)],
+            "reads": self.reads,
+            "pairs": self.pairs,
+            "peak_pending": self.peak_pending,
+            "eval_wall": self.time,
+            "reads_per_s": (self.reads / self.time) if self.time else None,
+        }
+
+
+class GroupedPairAccumulator:
+    """accumulator of read-pairs for an amplicon, kept separately for each group of reads
+
+    Reads are dispatched to one accumulator (of class acc, with the other
+    keyword options) per value of their split_tag (e.g.: read-group 'RG').
+    group_names maps tag values onto group names (e.g.: read-group ID to the
+    sample in its SM field, so that multiple lanes of the same sample are
+    counted together). Reads lacking the tag go to the group ''.
+
+    finish() returns the results of each group, including the groups listed
+    in group_names but without any read.
+    """
+
+    def __init__(
+        self,
+        mut_dict,
+        rq_b=None,
+        rq_e=None,
+        split_tag="RG",
+        group_names={},
+        acc=PairAccumulator,
+        **acc_opts,
+    ):
+        self.mut_dict = mut_dict
+        self.rq_b = rq_b
+        self.rq_e = rq_e
+        self.split_tag = split_tag
+        self.group_names = group_names
+        self.acc = acc
+        self.acc_opts = acc_opts
+        self.groups = {}
+
+    @property
+    def reads(self):
+        return sum(acc.reads for acc in self.groups.values())
+
+    def group(self, read):
+        """accumulator of the group of a read"""
+        value = (
+            str(read.get_tag(self.split_tag)) if read.has_tag(self.split_tag) else ""
+        )
+        name = self.group_names.get(value, value)
+        if name not in self.groups:
+            self.groups[name] = self.acc(
+                self.mut_dict, self.rq_b, self.rq_e, **self.acc_opts
+            )
+        return self.groups[name]
+
+    def add(self, read):
+        self.group(read).add(read)
+
+    def add_pair(self, reads):
+        # (mates belong to the same group)
+        self.group(reads[0]).add_pair(reads)
+
+    def finish(self):
+        # groups of the header first, in the same order
+        names = list(dict.fromkeys(self.group_names.values()))
+        names += [name for name in self.groups if name not in names]
+        results = {}
+        for name in names:
+            acc = self.groups.get(name) or self.acc(
+                self.mut_dict, self.rq_b, self.rq_e, **self.acc_opts
+            )
+            print(f"group {name}", end="\t")
+            results[name] = acc.finish()
+        return results
+
+    def profile(self):
+        """statistics of this amplicon, over all groups"""
+        profiles = [acc.profile() for acc in self.groups.values()]
+        reads = sum(p["reads"] for p in profiles)
+        wall = sum(p["eval_wall"] for p in profiles)
+        return {
+            "window": [int(self.rq_b), int(self.rq_e)],
+            "groups": len(profiles),
+            "reads": reads,
+            "pairs": sum(p["pairs"] for p in profiles),
+            "peak_pending": sum(p["peak_pending"] for p in profiles),
+            "eval_wall": wall,
+            "reads_per_s": (reads / wall) if wall else None,
+        }
+
+
+def accumulator(profile, acc_opts):
+    """class of accumulator used by the engines for a given profiling and options"""
+    Acc = PairAccumulator if profile is None else TimedPairAccumulator
+    if "split_tag" in acc_opts:
+        return functools.partial(GroupedPairAccumulator, acc=Acc)
+    return Acc
+
+
+def read_group_samples(alnfile):
+    """map the read-group IDs of the header of an alignment file onto their sample (SM)"""
     return {
-        "sites": (
-            dict(zip(sites_cnt[0].tolist(), sites_cnt[1].tolist()))
-            if len(all_sites)
-            else {}
-        ),
-        "muts": (
-            dict(zip(muts_cnt[0].tolist(), muts_cnt[1].tolist()))
-            if len(all_muts)
-            else {}
-        ),
+        rg["ID"]: rg.get("SM", rg["ID"])
+        for rg in alnfile.header.to_dict().get("RG", [])
     }
 
 
+# scan an amplicon for a specific set of mutations
+def scanamplicon(read_iter, mut_dict, rq_b=None, rq_e=None, **acc_opts):
+    acc = PairAccumulator(mut_dict, rq_b, rq_e, **acc_opts)
+    for read in read_iter:
+        acc.add(read)
+    return acc.finish()
+
+
 # TODO better naming
 def findbam(prefix, batch, sample):
     """function to find bam from prefix, batch and sample"""
@@ -124,30 +634,1214 @@ def findbam(prefix, batch, sample):
     return alnfname
 
 
-def scanbam(alnfname, amplicons, rq_chr):
-    """scan a bamfile found at alnfname"""
-    import pysam  # HACK pysam isn't available on bioconda aarch64, yet. So hot-load it only in the function that requires it. This lets all other parts of cojac working without it.
+def scanamplicons_fetch(alnfile, amplicons, rq_chr, profile=None, acc_opts={}):
+    """scan amplicons by fetching each query window in turn (uses the index)
+
+    Amplicons sharing the same query window (e.g.: same amplicon number with
+    different mutations sets from different variants) are grouped: the window
+    is fetched and decoded only once and each read is evaluated against all
+    of them. Windows are fetched in genomic order so that the reader moves
+    forward through the file instead of seeking back and forth.
+
+    profile: if a dict() is given, it is filled with statistics (see scanbam())
+    acc_opts: options of the PairAccumulator of each amplicon (subsampling, haplotypes)
+    """
+    Acc = accumulator(profile, acc_opts)
+
+    # group amplicons by query window
+    windows = {}
+    for amp_name, amp in amplicons.items():
+        (start, stop, rq_b, rq_e, mut_dict) = amp
+
+        # we need at least 2 to compute co-occurrence
+        if len(mut_dict) < 1:  # HACK 2:
+            continue
+
+        windows.setdefault((int(rq_b), int(rq_e)), []).append(amp_name)
+
+    amp_results = {}
+    decoded = 0
+    for rq_b, rq_e in sorted(windows):
+        t = time.perf_counter()
+        accs = [
+            (amp_name, Acc(amplicons[amp_name][4], rq_b, rq_e, **acc_opts))
+            for amp_name in windows[(rq_b, rq_e)]
+        ]
+        for read in alnfile.fetch(rq_chr, rq_b, rq_e):
+            for amp_name, acc in accs:
+                acc.add(read)
+        t = time.perf_counter() - t
+
+        for amp_name, acc in accs:
+            print(f"amplicon_{amp_name}", rq_b, rq_e, acc.mut_dict, sep="\t", end="\t")
+            amp_results[amp_name] = acc.finish()
+            if profile is not None:
+                # the window is fetched and decoded once for all its amplicons
+                profile.setdefault("amplicons", {})[amp_name] = dict(
+                    acc.profile(), window_wall=t, window_shared=len(accs)
+                )
+        decoded += accs[0][1].reads
+
+    if profile is not None:
+        profile["fetches"] = len(windows)
+        profile["reads_decoded"] = decoded
+
+    # keep the same order as the amplicons
+    return {a: amp_results[a] for a in amplicons if a in amp_results}
+
+
+def scanamplicons_stream(alnfile, amplicons, rq_chr, profile=None, acc_opts={}):
+    """scan amplicons in a single pass over the coordinate-sorted alignment
+
+    Instead of one fetch per amplicon, reads are streamed only once over the
+    whole span of the query windows and sent to every amplicon whose window
+    they overlap (same overlap rule as htslib's fetch), using an index of the
+    windows sorted by query start. Amplicons are finished as soon as the
+    stream has moved past their window.
+
+    profile: if a dict() is given, it is filled with statistics (see scanbam())
+    acc_opts: options of the PairAccumulator of each amplicon (subsampling, haplotypes)
+    """
+    Acc = accumulator(profile, acc_opts)
+
+    # index of query windows sorted by start
+    queries = sorted(
+        [
+            (int(amp[2]), int(amp[3]), amp_name)
+            for amp_name, amp in amplicons.items()
+            if len(amp[4]) >= 1  # HACK 2:
+        ]
+    )
+    if profile is not None:
+        profile.update({"fetches": 1 if len(queries) else 0, "reads_decoded": 0})
+    if not len(queries):
+        return {}
 
     amp_results = {}
-    with pysam.AlignmentFile(alnfname, "rb") as alnfile:
+
+    def finish(rq_b, rq_e, amp_name, acc):
+        print(f"amplicon_{amp_name}", rq_b, rq_e, acc.mut_dict, sep="\t", end="\t")
+        amp_results[amp_name] = acc.finish()
+        if profile is not None:
+            profile.setdefault("amplicons", {})[amp_name] = acc.profile()
+
+    nxt = 0  # next window to open
+    active = []  # (rq_b, rq_e, amp_name, accumulator) of opened windows
+    decoded = 0
+    for read in alnfile.fetch(rq_chr, queries[0][0], max(q[1] for q in queries)):
+        decoded += 1
+        r_b = read.reference_start
+        r_e = read.reference_end
+        if r_e is None or r_e <= r_b:
+            r_e = r_b + 1  # htslib's bam_endpos()
+
+        # retire windows that the stream has moved past
+        if len(active) and min(a[1] for a in active) <= r_b:
+            for a in active:
+                if a[1] <= r_b:
+                    finish(*a)
+            active = [a for a in active if a[1] > r_b]
+
+        # open windows that start before this read ends
+        while nxt < len(queries) and queries[nxt][0] < r_e:
+            (rq_b, rq_e, amp_name) = queries[nxt]
+            acc = Acc(amplicons[amp_name][4], rq_b, rq_e, **acc_opts)
+            if rq_e <= r_b:
+                # window already behind: no read at all
+                finish(rq_b, rq_e, amp_name, acc)
+            else:
+                active.append((rq_b, rq_e, amp_name, acc))
+            nxt += 1
+
+        for rq_b, rq_e, amp_name, acc in active:
+            if rq_b < r_e and r_b < rq_e:
+                acc.add(read)
+
+    # flush the remaining windows, including those never reached
+    for a in active:
+        finish(*a)
+    for rq_b, rq_e, amp_name in queries[nxt:]:
+        finish(
+            rq_b, rq_e, amp_name, Acc(amplicons[amp_name][4], rq_b, rq_e, **acc_opts)
+        )
+    if profile is not None:
+        profile["reads_decoded"] = decoded
+
+    # keep the same order as the amplicons
+    return {a: amp_results[a] for a in amplicons if a in amp_results}
+
+
+def collated_pairs(alnfile, rq_tid):
+    """group the consecutive mapped reads of a name-collated stream by query name
+
+    yields lists of reads, the reads mapped to other references are skipped
+    """
+    name = None
+    reads = []
+    for read in alnfile.fetch(until_eof=True):
+        if read.query_name != name:
+            if len(reads):
+                yield reads
+            name = read.query_name
+            reads = []
+        if read.reference_id == rq_tid and not read.is_unmapped:
+            reads.append(read)
+    if len(reads):
+        yield reads
+
+
+def scanamplicons_collate(alnfile, amplicons, rq_chr, profile=None, acc_opts={}):
+    """scan amplicons in a name-collated (or name-sorted) stream of alignments
+
+    Needs neither a coordinate-sorted input nor an index, so it can also read
+    a pipe from an aligner or 'samtools collate' on stdin ('-'). As mates are
+    adjacent, each pair is evaluated at once against every amplicon whose
+    query window one of its reads overlaps (same overlap rule as htslib's
+    fetch, i.e.: same results as the other engines) and no read ever needs to
+    be kept waiting for its mate: memory is constant.
+
+    profile: if a dict() is given, it is filled with statistics (see scanbam())
+    acc_opts: options of the PairAccumulator of each amplicon (subsampling, haplotypes)
+    """
+    assert (
+        alnfile.header.to_dict().get("HD", {}).get("SO") != "coordinate"
+    ), "the 'collate' engine needs mates to be adjacent, use 'fetch' or 'stream' for coordinate-sorted alignments"
+    Acc = accumulator(profile, acc_opts)
+
+    # index of query windows sorted by start
+    queries = sorted(
+        [
+            (int(amp[2]), int(amp[3]), amp_name)
+            for amp_name, amp in amplicons.items()
+            if len(amp[4]) >= 1  # HACK 2:
+        ]
+    )
+    starts = [q[0] for q in queries]
+    longest = max([q[1] - q[0] for q in queries], default=0)
+    accs = {
+        amp_name: Acc(amplicons[amp_name][4], rq_b, rq_e, **acc_opts)
+        for rq_b, rq_e, amp_name in queries
+    }
+
+    decoded = 0
+    rq_tid = alnfile.get_tid(rq_chr)
+    for reads in collated_pairs(alnfile, rq_tid):
+        decoded += len(reads)
+        # reads of the pair overlapping each amplicon's window
+        overlaps = {}
+        for read in reads:
+            r_b = read.reference_start
+            r_e = read.reference_end
+            if r_e is None or r_e <= r_b:
+                r_e = r_b + 1  # htslib's bam_endpos()
+            # only windows starting less than the longest window before could overlap
+            for i in range(
+                bisect.bisect_right(starts, r_b - longest),
+                bisect.bisect_left(starts, r_e),
+            ):
+                (rq_b, rq_e, amp_name) = queries[i]
+                if r_b < rq_e:
+                    overlaps.setdefault(amp_name, []).append(read)
+        for amp_name, amp_reads in overlaps.items():
+            accs[amp_name].add_pair(amp_reads)
+
+    amp_results = {}
+    for rq_b, rq_e, amp_name in queries:
+        acc = accs[amp_name]
+        print(f"amplicon_{amp_name}", rq_b, rq_e, acc.mut_dict, sep="\t", end="\t")
+        amp_results[amp_name] = acc.finish()
+        if profile is not None:
+            profile.setdefault("amplicons", {})[amp_name] = acc.profile()
+    if profile is not None:
+        profile.update({"fetches": 0, "reads_decoded": decoded})
+
+    # keep the same order as the amplicons
+    return {a: amp_results[a] for a in amplicons if a in amp_results}
+
+
+# scanbam() options which do not change the results (i.e.: irrelevant for caching)
+cache_neutral_opts = ("engine", "threads", "fasta")
+
+scan_engines = {
+    "fetch": scanamplicons_fetch,
+    "stream": scanamplicons_stream,
+    "collate": scanamplicons_collate,
+}
+
+
+def open_alignment(alnfname, threads=1, fasta=None):
+    """open an alignment file (BAM/CRAM/SAM) with pysam
+
+    threads: number of htslib threads used for BGZF/CRAM decompression of this file
+    fasta: local reference FASTA used to decode CRAM
+    """
+    import pysam  # HACK pysam isn't available on bioconda aarch64, yet. So hot-load it only in the function that requires it. This lets all other parts of cojac working without it.
+
+    return pysam.AlignmentFile(
+        alnfname, "rb", threads=threads, reference_filename=fasta
+    )
+
+
+def local_reference_only():
+    """prevent htslib from fetching CRAM references remotely (e.g.: from EBI)
+
+    (htslib only downloads references when REF_PATH is unset or contains URLs)
+    """
+    os.environ["REF_PATH"] = os.pathsep.join(
+        [
+            p
+            for p in os.environ.get("REF_PATH", "").split(os.pathsep)
+            if p and "://" not in p
+        ]
+        or ["."]
+    )
+
+
+def current_rss_kb():
+    """current resident memory of this process (not its peak), None if unavailable (only on Linux)"""
+    try:
+        with open("/proc/self/statm", "rt") as sf:
+            return int(sf.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def scanbam(
+    alnfname,
+    amplicons,
+    rq_chr,
+    engine="fetch",
+    profile=None,
+    threads=1,
+    fasta=None,
+    max_pairs=None,
+    ci_width=None,
+    haplotypes=False,
+    split_tag=None,
+    min_reads=None,
+    depths=None,
+):
+    """scan a bamfile found at alnfname
+
+    engine:
+            'fetch': one indexed fetch per distinct query window (best for few windows)
+            'stream': a single pass over the whole span of the amplicons (best for many windows)
+            'collate': a single pass over a name-collated input, no index needed (alnfname can be '-' for stdin)
+    profile:
+            if a dict() is given, it is filled with statistics: wall time, number of
+            fetches, reads decoded, pairs evaluated, reads/second, growth of the process'
+            resident memory during the scan (the peak of the process covers all the
+            samples it scanned so far: see write_profile() for the run's peak),
+            and per amplicon: reads, pairs, time evaluating reads, peak of pending mates.
+    threads:
+            number of htslib decompression threads, overlapping with the evaluation in python
+    fasta:
+            local reference FASTA used to decode CRAM files
+    max_pairs, ci_width:
+            subsample deep amplicons (see PairAccumulator), the results of
+            subsampled amplicons have an extra 'subsampled' entry with the
+            number of pairs used and the reason for stopping.
+    haplotypes:
+            also count the patterns of sites and mutations of each pair (see PairAccumulator)
+    split_tag:
+            count the reads separately for each value of this tag (e.g.: 'RG' to
+            demultiplex read-groups, which are then named after their sample),
+            in a single pass. Each amplicon's result is then a dict() of
+            { group: result }, see GroupedPairAccumulator and split_groups()
+    min_reads:
+            preflight: skip the amplicons with fewer reads than that in their query
+            window, they are reported with zero coverage (empty sites and muts).
+    depths:
+            the read counts of the preflight, if already known (see window_depths())
+    """
+    acc_opts = {
+        k: v
+        for k, v in {"max_pairs": max_pairs, "ci_width": ci_width}.items()
+        if v is not None
+    }
+    if haplotypes:
+        acc_opts["haplotypes"] = True
+    rss = current_rss_kb() if profile is not None else None
+    with open_alignment(alnfname, threads=threads, fasta=fasta) as alnfile:
         if rq_chr == None:
             # autoguess reference from alignment
             # HACK only using the first one
             # TODO handle multiple fragments (in the request itself)
             rq_chr = alnfile.references[0]
             print(f"autodecting reference as {rq_chr}")
-        for amp_name, amp in amplicons.items():
-            (start, stop, rq_b, rq_e, mut_dict) = amp
+        if split_tag:
+            acc_opts["split_tag"] = split_tag
+            acc_opts["group_names"] = (
+                read_group_samples(alnfile) if split_tag == "RG" else {}
+            )
+
+        t = time.perf_counter()
+        skipped = []
+        if min_reads:
+            if depths is None:
+                depths = window_depths(alnfile, amplicons, rq_chr)
+            skipped = [
+                a
+                for a, amp in amplicons.items()
+                if len(amp[4]) >= 1 and depths[a] < min_reads  # HACK 2:
+            ]
+            if len(skipped):
+                print(
+                    f"preflight: skipping {len(skipped)} amplicons with less than {min_reads} reads"
+                )
+        amp_results = scan_engines[engine](
+            alnfile,
+            {a: amp for a, amp in amplicons.items() if a not in skipped},
+            rq_chr,
+            acc_opts=acc_opts,
+            **({} if profile is None else {"profile": profile}),
+        )
+        if len(skipped):
+            # zero coverage, keeping the same order as the amplicons
+            amp_results = {
+                a: amp_results[a] if a in amp_results else empty_result(split_tag)
+                for a in amplicons
+                if a in amp_results or a in skipped
+            }
+        if profile is None:
+            return amp_results
+
+        t = time.perf_counter() - t
+        amps = profile.pop("amplicons", {})
+        profile.update(
+            {
+                "alignment": alnfname,
+                "engine": engine,
+                "wall": t,
+                "pairs": sum(a["pairs"] for a in amps.values()),
+                "reads_per_s": (profile["reads_decoded"] / t) if t else None,
+                "rss_growth_kb": (current_rss_kb() - rss if rss is not None else None),
+                "skipped": len(skipped),
+                "amplicons": amps,
+            }
+        )
+        return amp_results
+
+
+def empty_result(split_tag=None):
+    """result of an amplicon without any read"""
+    return {} if split_tag else {"sites": {}, "muts": {}}
+
+
+#
+# process pool for scanning multiple alignments in parallel
+#
+
+# per-worker copy of the amplicon query, set only once by the pool initializer
+# (instead of being pickled along with every single task)
+pool_amplicons = None
+pool_rq_chr = None
+pool_scan_opts = {}
+pool_profiling = False
+
+
+def pool_init(amplicons, rq_chr, scan_opts, profiling=False):
+    """process pool initializer: store the amplicon query in the worker"""
+    global pool_amplicons, pool_rq_chr, pool_scan_opts, pool_profiling
+    pool_amplicons = amplicons
+    pool_rq_chr = rq_chr
+    pool_scan_opts = scan_opts
+    pool_profiling = profiling
+
+
+def scanbam_profiled(alnfname, amplicons, rq_chr, profiling, scan_opts):
+    """scanbam() returning a tuple (results, profile), profile being None if not profiling"""
+    if not profiling:
+        return (scanbam(alnfname, amplicons, rq_chr, **scan_opts), None)
+    profile = {}
+    return (scanbam(alnfname, amplicons, rq_chr, profile=profile, **scan_opts), profile)
+
+
+def pool_scanbam_subset(task):
+    """process pool task: scan (a subset of) the amplicons of one alignment file
+
+    each worker opens its own pysam handle
+    """
+    (alnfname, amp_names, depths) = task
+    return scanbam_profiled(
+        alnfname,
+        {a: pool_amplicons[a] for a in amp_names},
+        pool_rq_chr,
+        pool_profiling,
+        dict(pool_scan_opts, depths=depths) if depths else pool_scan_opts,
+    )
+
+
+def pool_mapped_reads(alnfname):
+    """process pool task: number of mapped reads of one alignment file, from its index"""
+    return mapped_reads(
+        alnfname,
+        pool_rq_chr,
+        **{k: v for k, v in pool_scan_opts.items() if k in ("threads", "fasta")},
+    )
+
+
+def merge_profiles(profiles):
+    """merge the profiles of the shards of a single alignment file"""
+    merged = dict(profiles[0])
+    merged["amplicons"] = {}
+    for key in ["fetches", "reads_decoded", "pairs"]:
+        merged[key] = sum(p[key] for p in profiles)
+    # shards run in parallel
+    merged["wall"] = max(p["wall"] for p in profiles)
+    merged["reads_per_s"] = (
+        (merged["reads_decoded"] / merged["wall"]) if merged["wall"] else None
+    )
+    # (shards run in separate processes at the same time)
+    merged["rss_growth_kb"] = (
+        sum(p["rss_growth_kb"] for p in profiles)
+        if all(p["rss_growth_kb"] is not None for p in profiles)
+        else None
+    )
+    merged["shards"] = len(profiles)
+    # (keep amplicons last)
+    merged["amplicons"] = merged.pop("amplicons")
+    for p in profiles:
+        merged["amplicons"].update(p["amplicons"])
+    return merged
+
+
+def query_window(amp):
+    """query window of an amplicon, shared by the amplicons of the same number"""
+    return (int(amp[2]), int(amp[3]))
+
+
+def index_mapped(alnfile, rq_chr):
+    """number of reads mapped on rq_chr according to the index statistics, None if unavailable"""
+    try:
+        return {s.contig: s.mapped for s in alnfile.get_index_statistics()}.get(
+            rq_chr, 0
+        )
+    except (AttributeError, ValueError):
+        # (no statistics in CRAM indexes)
+        return None
+
+
+def window_depths(alnfile, amplicons, rq_chr):
+    """preflight: count the reads in each amplicon's query window of an (indexed) alignment file
+
+    Uses the index only: its statistics tell if any read is mapped at all on
+    rq_chr (e.g.: dropout samples, without anything to decode), then each
+    distinct window gets a region count, done by htslib without creating
+    python objects (i.e.: much cheaper than scanning).
+
+    Returns:
+            dict() of amplicon name : number of reads
+    """
+    mapped = index_mapped(alnfile, rq_chr)
+    counts = {}
+    depths = {}
+    for amp_name, amp in amplicons.items():
+        window = query_window(amp)
+        if window not in counts:
+            counts[window] = (
+                alnfile.count(rq_chr, *window, read_callback="nofilter")
+                if mapped != 0
+                else 0
+            )
+        depths[amp_name] = counts[window]
+    return depths
+
+
+def amplicon_depths(alnfname, amplicons, rq_chr, threads=1, fasta=None):
+    """count the reads in each amplicon's query window of an (indexed) alignment file
+
+    Returns:
+            dict() of amplicon name : number of reads
+    """
+    with open_alignment(alnfname, threads=threads, fasta=fasta) as alnfile:
+        if rq_chr == None:
+            rq_chr = alnfile.references[0]
+        return window_depths(alnfile, amplicons, rq_chr)
 
-            # we need at least 2 to compute co-occurrence
-            if len(mut_dict) < 1:  # HACK 2:
-                continue
 
-            print(f"amplicon_{amp_name}", rq_b, rq_e, mut_dict, sep="\t", end="\t")
+def shard_depth(depths, names, amplicons=None):
+    """total read depth of a shard, counting each query window only once"""
+    if amplicons is None:
+        return sum(depths[a] for a in names)
+    return sum({query_window(amplicons[a]): depths[a] for a in names}.values())
 
-            amplicon_iter = alnfile.fetch(rq_chr, rq_b, rq_e)
-            amp_results[amp_name] = scanamplicon(amplicon_iter, mut_dict)
-    return amp_results
+
+def mapped_reads(alnfname, rq_chr, threads=1, fasta=None):
+    """number of reads mapped on rq_chr of an alignment file, only reading its index
+
+    Returns:
+            number of reads, or None if the index has no statistics (e.g.: CRAM)
+    """
+    with open_alignment(alnfname, threads=threads, fasta=fasta) as alnfile:
+        if rq_chr == None:
+            rq_chr = alnfile.references[0]
+        return index_mapped(alnfile, rq_chr)
+
+
+def balance_amplicons(depths, shards, amplicons=None):
+    """split amplicons into shards of roughly equal total read depth
+
+    (greedy: heaviest amplicons first, each to the currently lightest shard)
+
+    If the amplicons' definitions are given, those sharing the same query
+    window are kept together in the same shard (so that the window is only
+    fetched and decoded once, see scanamplicons_fetch()) and weigh only once.
+
+    Returns:
+            list of lists of amplicon names, each keeping the original order of depths
+    """
+    order = {a: i for i, a in enumerate(depths)}
+    groups = {}
+    for a in depths:
+        groups.setdefault(
+            a if amplicons is None else query_window(amplicons[a]), []
+        ).append(a)
+    load = [0] * shards
+    bins = [[] for i in range(shards)]
+    for g in sorted(groups.values(), key=lambda g: depths[g[0]], reverse=True):
+        i = load.index(min(load))
+        bins[i] += g
+        load[i] += depths[g[0]]
+    return [sorted(b, key=order.get) for b in bins if len(b)]
+
+
+def scanbam_all(
+    alnfnames,
+    amplicons,
+    rq_chr,
+    jobs=1,
+    split_amplicons=False,
+    scan_opts={},
+    subsets=None,
+    profiles=None,
+):
+    """scan a list of alignment files, optionally using a pool of jobs processes
+
+    scan_opts are passed as keyword arguments to scanbam()
+
+    With split_amplicons, the amplicons of each single alignment file are
+    split across the processes (balanced by read depth, amplicons sharing a
+    query window staying together) instead of scanning multiple files at the
+    same time. Useful for few very deep samples.
+
+    subsets can give, for each alignment file, the list of amplicon names to
+    scan instead of all the amplicons.
+
+    With multiple jobs, the heaviest alignment files get started first,
+    according to the number of mapped reads in their index statistics (i.e.:
+    without decoding anything). With split_amplicons, a preflight counts the
+    reads of each query window (see window_depths()) to balance the shards and
+    start the heaviest first.
+
+    If profiles is a list, the profile of each scan (see scanbam()) is appended to it.
+
+    Returns:
+            a generator of scanbam() results, in the same order as alnfnames
+    """
+    if subsets is None:
+        subsets = [None] * len(alnfnames)
+    profiling = profiles is not None
+
+    def subset(names):
+        return amplicons if names is None else {a: amplicons[a] for a in names}
+
+    def unpack(scanned):
+        (result, profile) = scanned
+        if profiling:
+            profiles.append(profile)
+        return result
+
+    if jobs is None or jobs <= 1 or (len(alnfnames) <= 1 and not split_amplicons):
+        for alnfname, names in zip(alnfnames, subsets):
+            yield unpack(
+                scanbam_profiled(alnfname, subset(names), rq_chr, profiling, scan_opts)
+            )
+        return
+
+    import multiprocessing
+
+    with multiprocessing.Pool(
+        processes=jobs if split_amplicons else min(jobs, len(alnfnames)),
+        initializer=pool_init,
+        initargs=(amplicons, rq_chr, scan_opts, profiling),
+    ) as pool:
+        if not split_amplicons:
+            tasks = [
+                (alnfname, list(amplicons.keys()) if names is None else names)
+                for alnfname, names in zip(alnfnames, subsets)
+            ]
+            if scan_opts.get("engine") == "collate":
+                # no index to look at
+                order = list(range(len(tasks)))
+            else:
+                # heaviest alignment files first (unknown last)
+                mapped = pool.map(pool_mapped_reads, alnfnames, chunksize=1)
+                order = sorted(
+                    range(len(tasks)),
+                    key=lambda i: -1 if mapped[i] is None else mapped[i],
+                    reverse=True,
+                )
+            # but results are returned in the order of the input
+            done = {}
+            nxt = 0
+            for i, scanned in zip(
+                order,
+                pool.imap(
+                    pool_scanbam_subset,
+                    [tasks[i] + (None,) for i in order],
+                    chunksize=1,
+                ),
+            ):
+                done[i] = scanned
+                while nxt in done:
+                    yield unpack(done.pop(nxt))
+                    nxt += 1
+            return
+
+        for alnfname, names in zip(alnfnames, subsets):
+            amps = subset(names)
+            depths = amplicon_depths(
+                alnfname,
+                amps,
+                rq_chr,
+                **{k: v for k, v in scan_opts.items() if k in ("threads", "fasta")},
+            )
+            # heaviest shards first
+            shards = sorted(
+                balance_amplicons(depths, jobs, amps),
+                key=lambda b: shard_depth(depths, b, amps),
+                reverse=True,
+            )
+            merged = {}
+            shard_profiles = []
+            for amp_results, profile in pool.map(
+                pool_scanbam_subset,
+                [(alnfname, b, {a: depths[a] for a in b}) for b in shards],
+                chunksize=1,
+            ):
+                merged.update(amp_results)
+                shard_profiles.append(profile)
+            if profiling:
+                profiles.append(merge_profiles(shard_profiles))
+            # merge back in the same order as a serial scan
+            yield {a: merged[a] for a in amps if a in merged}
+
+
+def scanbam_cached(
+    alnfnames,
+    amplicons,
+    rq_chr,
+    cache,
+    jobs=1,
+    split_amplicons=False,
+    scan_opts={},
+    profiles=None,
+):
+    """scan a list of alignment files like scanbam_all(), but only what isn't found in the cache
+
+    The cache works per amplicon definition (query window and mutations, see
+    amplicon_key()) rather than per label: when the amplicon query changes
+    (e.g.: a new VOC gets added, and labels get renamed and merged), only the
+    new or changed definitions are scanned in the existing alignment files,
+    and the labels are mapped onto the cached counts.
+
+    Returns:
+            a generator of scanbam() results, in the same order as alnfnames
+    """
+    params = {k: v for k, v in scan_opts.items() if k not in cache_neutral_opts}
+    amp_keys = {a: amplicon_key(q) for a, q in amplicons.items() if len(q[4]) >= 1}
+
+    keys = []
+    entries = []
+    missing = []
+    for alnfname in alnfnames:
+        key = cache.key(alnfname, params)
+        entry = cache.get(key) or {}
+        todo = [a for a, k in amp_keys.items() if k not in entry]
+        cache.hits += len(amp_keys) - len(todo)
+        cache.misses += len(todo)
+        if len(todo) == 0:
+            print(f"cached: {alnfname}")
+        elif len(entry):
+            print(f"cached: {alnfname}, rescanning {len(todo)} amplicons")
+        keys.append(key)
+        entries.append(entry)
+        missing.append(todo)
+
+    scanned = scanbam_all(
+        [alnfname for alnfname, todo in zip(alnfnames, missing) if len(todo)],
+        amplicons,
+        rq_chr,
+        jobs=jobs,
+        split_amplicons=split_amplicons,
+        scan_opts=scan_opts,
+        subsets=[todo for todo in missing if len(todo)],
+        profiles=profiles,
+    )
+    for key, entry, todo in zip(keys, entries, missing):
+        if len(todo):
+            entry.update({amp_keys[a]: r for a, r in next(scanned).items()})
+            cache.put(key, entry)
+        yield {a: entry[k] for a, k in amp_keys.items()}
+    # (once for the whole run: listing the cache is slow on network filesystems)
+    cache.evict()
+
+
+def split_groups(result, default_name):
+    """turn a scanbam() result split by groups into one result per group
+
+    (the group of reads lacking the tag is named default_name)
+
+    Returns:
+            dict() of { group name: { amplicon: result } }
+    """
+    groups = {}
+    for amp_name, amp in result.items():
+        for group, res in amp.items():
+            groups.setdefault(group or default_name, {})[amp_name] = res
+    # groups without reads in some amplicons
+    return {
+        group: {
+            amp_name: amps.get(amp_name, {"sites": {}, "muts": {}})
+            for amp_name in result
+        }
+        for group, amps in groups.items()
+    }
+
+
+def write_profile(profile_fname, profiles, scanned, wall):
+    """write the profiles of all the scans (see scanbam()) and a summary as JSON
+
+    scanned: list of (sample, alignment file) that were scanned
+    """
+    samples = {alnfname: sample for sample, alnfname in scanned}
+    reads = sum(p["reads_decoded"] for p in profiles)
+    with open(profile_fname, "wt") as jf:
+        json.dump(
+            obj={
+                "total": {
+                    "wall": wall,
+                    "samples": len(profiles),
+                    "fetches": sum(p["fetches"] for p in profiles),
+                    "reads_decoded": reads,
+                    "pairs": sum(p["pairs"] for p in profiles),
+                    "reads_per_s": (reads / wall) if wall else None,
+                    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    "peak_rss_children_kb": resource.getrusage(
+                        resource.RUSAGE_CHILDREN
+                    ).ru_maxrss,
+                },
+                "samples": [
+                    dict({"sample": samples.get(p["alignment"])}, **p) for p in profiles
+                ],
+            },
+            fp=jf,
+            indent=1,
+        )
+
+
+#
+# dry-run cost estimates
+#
+
+# memory used by each read waiting for its mate in PairAccumulator.pending (measured with tracemalloc)
+pending_mate_bytes = 200
+
+
+def explain_alignment(
+    alnfname, amplicons, rq_chr, engine="fetch", threads=1, fasta=None
+):
+    """estimate the cost of scanning an alignment file, reading only its header and index
+
+    Reads are assumed to be spread evenly along the reference (as with a
+    tiled amplicon protocol), so a window gets a share of the mapped reads
+    (from the index statistics) proportional to its length, plus the reads
+    overlapping its boundaries.
+
+    Name-collated inputs (engine 'collate') have no index: all their reads
+    get decoded, their number is extrapolated from the file size and the
+    bytes taken by the first explain_sample_reads reads.
+
+    Returns:
+            dict() with the estimated fetches, reads decoded, peak of mates
+            pending pairing, and the number of mapped reads, or None if the
+            index has no statistics (e.g.: CRAM) or for collated inputs which
+            are not a BAM or SAM file (e.g.: stdin, CRAM)
+    """
+    if engine == "collate":
+        return explain_collated(alnfname, amplicons, threads=threads, fasta=fasta)
+    with open_alignment(alnfname, threads=threads, fasta=fasta) as alnfile:
+        if rq_chr == None:
+            rq_chr = alnfile.references[0]
+        ref_len = alnfile.get_reference_length(rq_chr)
+        try:
+            stats = {s.contig: s for s in alnfile.get_index_statistics()}
+        except (AttributeError, ValueError):
+            return None
+        mapped = stats[rq_chr].mapped if rq_chr in stats else 0
+        # one read to know their length
+        read_len = 150
+        for read in alnfile.fetch(rq_chr):
+            read_len = read.query_length or read_len
+            break
+
+    windows = sorted(
+        {(int(amp[2]), int(amp[3])) for amp in amplicons.values() if len(amp[4]) >= 1}
+    )
+
+    def reads(b, e):
+        return min(mapped, mapped * (e - b + read_len) / ref_len)
+
+    window_reads = [reads(b, e) for b, e in windows]
+    if engine == "stream":
+        decoded = reads(windows[0][0], max(e for b, e in windows)) if windows else 0
+        fetches = 1 if windows else 0
+    else:
+        decoded = sum(window_reads)
+        fetches = len(windows)
+    return {
+        "fetches": fetches,
+        "reads": int(decoded),
+        # at worst, one mate of each pair of the deepest window
+        "peak_pending": int(max(window_reads, default=0) / 2),
+        "mapped": mapped,
+        "windows": len(windows),
+    }
+
+
+# number of reads decoded to extrapolate the size of collated inputs
+explain_sample_reads = 10000
+
+
+def explain_collated(alnfname, amplicons, threads=1, fasta=None):
+    """estimate the cost of scanning a name-collated alignment file (see explain_alignment())"""
+    if alnfname == "-" or not os.path.isfile(alnfname):
+        return None
+    size = os.path.getsize(alnfname)
+    with open_alignment(alnfname, threads=threads, fasta=fasta) as alnfile:
+        if alnfile.is_bam:
+            # (BGZF virtual offsets: the compressed offset is in the upper bits)
+            offset = lambda: alnfile.tell() >> 16
+        elif alnfile.is_sam:
+            offset = alnfile.tell
+        else:
+            return None
+        start = offset()
+        n = 0
+        for read in alnfile.fetch(until_eof=True):
+            n += 1
+            if n >= explain_sample_reads:
+                break
+        used = offset() - start
+    if n == explain_sample_reads and used > 0:
+        n = int(n * (size - start) / used)
+    return {
+        "fetches": 0,
+        "reads": n,
+        # mates are adjacent
+        "peak_pending": 0,
+        "mapped": None,
+        "windows": len(
+            {query_window(amp) for amp in amplicons.values() if len(amp[4]) >= 1}
+        ),
+    }
+
+
+def load_calibration(calibration):
+    """scanning speed (reads per second, of a single process) from a --profile JSON"""
+    with open(calibration, "rt") as jf:
+        samples = json.load(fp=jf)["samples"]
+    wall = sum(p["wall"] for p in samples)
+    return sum(p["reads_decoded"] for p in samples) / wall if wall else None
+
+
+def explain_scan(todo, amplicons, rq_chr, jobs=1, calibration=None, scan_opts={}):
+    """print the estimated cost of a scan, without scanning (see explain_alignment())
+
+    todo: list of (sample, alignment file)
+    calibration: --profile JSON of a previous run (on the same hardware), to project the runtime
+    """
+    rate = load_calibration(calibration) if calibration else None
+    print(
+        "sample",
+        "fetches",
+        "est_reads",
+        "est_peak_pending",
+        "est_memory_MB",
+        "est_runtime_s",
+        sep="\t",
+    )
+    totals = {"fetches": 0, "reads": 0, "peak_pending": 0}
+    runtimes = []
+    unknown = 0
+    for sample, alnfname in todo:
+        est = explain_alignment(
+            alnfname,
+            amplicons,
+            rq_chr,
+            **{
+                k: v
+                for k, v in scan_opts.items()
+                if k in ("engine", "threads", "fasta")
+            },
+        )
+        if est is None:
+            unknown += 1
+            print(sample, *(["NA"] * 5), sep="\t")
+            continue
+        runtime = est["reads"] / rate if rate else None
+        runtimes.append(runtime or 0)
+        for k in totals:
+            totals[k] = (max if k == "peak_pending" else sum)([totals[k], est[k]])
+        print(
+            sample,
+            est["fetches"],
+            est["reads"],
+            est["peak_pending"],
+            f"{est['peak_pending'] * pending_mate_bytes / 2**20:.1f}",
+            f"{runtime:.3g}" if rate else "NA",
+            sep="\t",
+        )
+
+    # jobs: no faster than the longest sample
+    wall = max(sum(runtimes) / jobs, max(runtimes, default=0)) if rate else None
+    print(
+        "total",
+        totals["fetches"],
+        totals["reads"],
+        totals["peak_pending"],
+        f"{totals['peak_pending'] * pending_mate_bytes / 2**20:.1f}",
+        f"{wall:.3g}" if rate else "NA",
+        sep="\t",
+    )
+    print(
+        f"projected with {jobs} jobs: {f'{wall:.3g}s' if rate else 'NA (use --calibration with a --profile JSON of a previous run)'}"
+        + (
+            f", {unknown} samples without estimate (no index statistics, or stdin)"
+            if unknown
+            else ""
+        ),
+        file=sys.stderr,
+    )
+    return {"wall": wall, **totals}
+
+
+#
+# checkpointing of long runs
+#
+
+
+def journal_query(amplicons, scan_opts={}):
+    """header of a journal: the amplicon query and the scanbam() options changing the results"""
+    return {
+        **query_info(amplicons),
+        "options": {k: v for k, v in scan_opts.items() if k not in cache_neutral_opts},
+    }
+
+
+def load_journal(journal, query=None):
+    """load the results of samples already scanned from a JSON Lines journal
+
+    query: if given, the journal_query() that the journal's header must match,
+            so that a restart with another query or other options cannot mix in stale samples
+
+    Returns:
+            dict() of sample name : scanbam() results
+    """
+    if not os.path.isfile(journal):
+        return {}
+    header = None
+    done = {}
+    for sample, result in iter_jsonl(journal):
+        if sample == query_key:
+            header = result
+        else:
+            done[sample] = result
+    if query is not None and (header is not None or len(done)):
+        assert (
+            header == query
+        ), f"Error: journal {journal} was written with a different amplicon query or different options, delete it or use another one"
+    return done
+
+
+def open_journal(journal, query=None):
+    """open a JSON Lines journal for appending (or a do-nothing context if None)
+
+    query: journal_query() written as header when starting a new journal
+    """
+    if not journal:
+        return contextlib.nullcontext()
+    jf = open(journal, "at")
+    if jf.tell() > 0:
+        # make sure to start on a new line, in case of a truncated last line
+        with open(journal, "rb") as rf:
+            rf.seek(-1, os.SEEK_END)
+            if rf.read(1) != b"\n":
+                jf.write("\n")
+    elif query is not None:
+        print(json.dumps({query_key: query}), file=jf, flush=True)
+    return jf
+
+
+def append_journal(jf, sample, result):
+    """append the results of one sample to the journal, as soon as it's available"""
+    print(json.dumps({"sample": sample, "result": result}), file=jf, flush=True)
+
+
+def open_jsonl(fname):
+    """open a JSON Lines result file for writing, gzip-compressed if ending in '.gz' (or a do-nothing context if None)"""
+    if not fname:
+        return contextlib.nullcontext()
+    if fname.endswith(".gz"):
+        return gzip.open(fname, "wt")
+    return open(fname, "wt")
+
+
+def iter_jsonl(fname):
+    """read a JSON Lines result file (or journal) one sample at a time
+
+    Files ending in '.gz' are decompressed. Truncated last lines (e.g.: of a job
+    still running, or killed) are skipped.
+
+    Returns:
+            generator of (sample name, scanbam() results), and of
+            (query_key, query_info()) for the header record if present
+    """
+    with gzip.open(fname, "rt") if fname.endswith(".gz") else open(fname, "rt") as jf:
+        try:
+            for line in jf:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    # e.g.: last line truncated by a killed job
+                    continue
+                if query_key in rec:
+                    yield (query_key, rec[query_key])
+                else:
+                    yield (rec["sample"], restore_result(rec["result"]))
+        except EOFError:
+            # gzip stream not terminated yet
+            pass
+
+
+def amplicon_summary(amp):
+    """summary counts of an amplicon at the topmost number of sites covered by read-pairs
+
+    Returns:
+            (cooc, count, mut_all, mut_oneless): topmost number of sites (or
+            None if not covered), read-pairs covering that many sites, and
+            among them carrying all, and all but one, of the mutations
+    """
+    if not amp["sites"]:  # empty ?
+        return (None, 0, 0, 0)
+    # (JSON only has string keys)
+    (cooc, count) = map(int, list(amp["sites"].items())[-1])
+    muts = {int(l): int(c) for l, c in amp["muts"].items() if int(l) >= 1}
+    return (cooc, count, muts.get(cooc, 0), muts.get(cooc - 1, 0))
+
+
+# long-format columnar tables
+columnar_columns = {
+    "sample": "category",
+    "batch": "category",
+    "amplicon": "category",
+    "cooc": "Int32",
+    "count": "int64",
+    "mut_all": "int64",
+    "mut_oneless": "int64",
+    "frac": "float64",
+}
+
+
+def columnar_table(samples, batchname=None):
+    """long-format table of results, one row per sample and amplicon
+
+    Input:
+            samples: iterable of (sample name, scanbam() results)
+            batchname: separator of samplename/batchname, to fill the batch column
+    Returns:
+            pd.DataFrame with columns columnar_columns
+    """
+    rows = []
+    for sam, amplicons in samples:
+        if sam == query_key:
+            continue
+        batch = None
+        if batchname:
+            (sam, ignore, batch) = sam.rpartition(batchname)
+            if not sam:
+                sam = batch
+                batch = None
+        for ampname, amp in amplicons.items():
+            (cooc, count, mut_all, mut_oneless) = amplicon_summary(amp)
+            rows.append(
+                (
+                    sam,
+                    batch,
+                    ampname,
+                    cooc,
+                    count,
+                    mut_all,
+                    mut_oneless,
+                    (mut_all / count) if count else float("nan"),
+                )
+            )
+    return pd.DataFrame.from_records(rows, columns=list(columnar_columns)).astype(
+        columnar_columns
+    )
+
+
+def write_columnar(df, fname):
+    """write a table as Parquet, or as Arrow IPC if ending in '.arrow' or '.feather' (requires pyarrow)"""
+    if fname.endswith((".arrow", ".feather")):
+        df.to_feather(fname)
+    else:
+        df.to_parquet(fname, index=False)
+
+
+def read_columnar(fname):
+    """read a table written by write_columnar() (requires pyarrow)"""
+    if fname.endswith((".arrow", ".feather")):
+        return pd.read_feather(fname)
+    return pd.read_parquet(fname)
+
+
+def columnar_results(df, batchname="/"):
+    """results of each sample, from a long-format table
+
+    Only the summary counts of amplicon_summary() are stored in the table:
+    the histograms are rebuilt with the topmost number of sites only.
+
+    Input:
+            batchname: separator to join back samplename/batchname
+    Returns:
+            generator of (sample name, results)
+    """
+    sam = None
+    result = {}
+    for row in df.itertuples(index=False):
+        name = (
+            f"{row.sample}{batchname}{row.batch}"
+            if not pd.isna(row.batch)
+            else row.sample
+        )
+        if name != sam:
+            if sam is not None:
+                yield (sam, result)
+            (sam, result) = (name, {})
+        sites = {}
+        muts = {}
+        if not pd.isna(row.cooc):
+            cooc = int(row.cooc)
+            sites[cooc] = int(row.count)
+            if row.mut_oneless and cooc > 1:
+                muts[cooc - 1] = int(row.mut_oneless)
+            if row.mut_all:
+                muts[cooc] = int(row.mut_all)
+        result[row.amplicon] = {"sites": sites, "muts": muts}
+    if sam is not None:
+        yield (sam, result)
 
 
 def make_amplicons_dict(amp_bed, mut_dict, voc_name="", cooc=2):
@@ -164,30 +1858,32 @@ def make_amplicons_dict(amp_bed, mut_dict, voc_name="", cooc=2):
                     for each amplicon where cooccurrences could be found
     """
     mut_df = pd.DataFrame({"position": mut_dict.keys(), "mutation": mut_dict.values()})
+    # sort so that definitions with same mutations in different categories all yield identic result
+    # (e.g.: YAML definitions with either "{mut:{123:A,567:C}}" or "{mut:{567:C},extra:{123:A}}"  or "{mut:{123:A},extra:{567:C}}"
+    # will all always consistently yield a tmp_mut_dict with "{123:A,567:C}" )
+    mut_df = mut_df.sort_values(by="position", kind="stable")
+    positions = mut_df["position"].to_numpy()
+    mutations = mut_df["mutation"].to_numpy()
     amplicons_dict = {}
 
     mincoocthresh = (
         cooc if len(mut_dict) > 1 else 1
     )  # HACK exception for early B.1 variant defined by a single mutation (A23403G : D614G aka Doug)
-    for i in range(amp_bed.shape[0]):
-        start, end, qstart, qstop = amp_bed.iloc[i].loc[
-            ["start", "stop", "qstart", "qstop"]
-        ]
-        t_df = mut_df[(start <= mut_df["position"]) & (mut_df["position"] <= end)]
-        tmp_mut_dict = dict()
-        for j in range(t_df.shape[0]):
-            tmp_mut_dict[t_df.iloc[j]["position"]] = t_df.iloc[j]["mutation"]
+    # (row by row access to the DataFrame is slow: get the windows all at once)
+    windows = amp_bed[["start", "stop", "qstart", "qstop"]].to_numpy()
+    for i, (start, end, qstart, qstop) in enumerate(windows):
+        # mutations within [start, end]
+        b = np.searchsorted(positions, start, side="left")
+        e = np.searchsorted(positions, end, side="right")
+        tmp_mut_dict = dict(zip(positions[b:e], mutations[b:e]))
 
         if len(tmp_mut_dict) >= mincoocthresh:
-            # sort so that definitions with same mutations in different categories all yield identic result
-            # (e.g.: YAML definitions with either "{mut:{123:A,567:C}}" or "{mut:{567:C},extra:{123:A}}"  or "{mut:{123:A},extra:{567:C}}"
-            # will all always consistently yield a tmp_mut_dict with "{123:A,567:C}" )
             amplicons_dict["{}_{}".format(i + 1, voc_name)] = [
                 start,
                 end,
                 qstart,
                 qstop,
-                dict(sorted(tmp_mut_dict.items())),
+                tmp_mut_dict,
             ]
 
     return amplicons_dict
@@ -292,6 +1988,13 @@ def make_all_amplicons(amp_bed, vocs, revert=False, n_cooc=2, subset_fix=True):
 
     # make amplicon dict for each voc
     amplicons = {}
+    # index of the amplicons by number and mutations, to find identical amplicons
+    # (the same number means the same window)
+    index = {}
+
+    def index_key(k, d):
+        return (k.split("_")[0], frozenset(d[4].items()))
+
     for yam in loaded_yamls:
         amp_dict = make_amplicons_dict(amp_bed, yam["mut"], yam["name"], n_cooc)
 
@@ -300,31 +2003,33 @@ def make_all_amplicons(amp_bed, vocs, revert=False, n_cooc=2, subset_fix=True):
         #  - G23012A  E484K
         #  - A23063T  N501Y
         # both on Spike's RBD
-        for k1, d1 in list(amp_dict.items()):  # WARNING inefficient but functional
-            ampname = k1.split("_")[0]
-            for k2, d2 in list(amplicons.items()):
-                npart = k2.split("_")
-                # search same amplicon number
-                if npart[0] != ampname:
-                    continue
-
-                # compare amplicon definitions
-                if d1 != d2:
-                    # if we're only interested in matches
-                    continue
+        for k1, d1 in list(amp_dict.items()):
+            key = index_key(k1, d1)
+            k2 = index.get(key)
+            if k2 is None:
+                # if we're only interested in matches
+                continue
 
-                print(
-                    f"{k1} is identical to {k2}: {  ','.join([ f'{p}{b}' for p, b in d1[4].items() ])}"
-                )
-                # sort the variant names part of the list, to be consistent between calls, no matter the filesystem's on-disk order
-                # (i.e.: no 76_AY42_IN2 vs 76_IN2_AY42)
-                newk2 = "_".join([npart[0]] + sorted(npart[1:] + [yam["name"]]))
-                print(f"\t{k2} => {newk2}")
-                amplicons[newk2] = amplicons.pop(k2)
-                del amp_dict[k1]
-                break
+            npart = k2.split("_")
+            print(
+                f"{k1} is identical to {k2}: {  ','.join([ f'{p}{b}' for p, b in d1[4].items() ])}"
+            )
+            # sort the variant names part of the list, to be consistent between calls, no matter the filesystem's on-disk order
+            # (i.e.: no 76_AY42_IN2 vs 76_IN2_AY42)
+            newk2 = "_".join([npart[0]] + sorted(npart[1:] + [yam["name"]]))
+            print(f"\t{k2} => {newk2}")
+            if newk2 in amplicons:
+                # (e.g.: same variant name given twice: overwritten)
+                index.pop(index_key(newk2, amplicons[newk2]), None)
+            amplicons[newk2] = amplicons.pop(k2)
+            index[key] = newk2
+            del amp_dict[k1]
 
         # merge dicts
+        for k, d in amp_dict.items():
+            if k in amplicons:
+                index.pop(index_key(k, amplicons[k]), None)
+            index[index_key(k, d)] = k
         if len(amp_dict):
             amplicons.update(amp_dict)
 
@@ -347,6 +2052,14 @@ def make_all_amplicons(amp_bed, vocs, revert=False, n_cooc=2, subset_fix=True):
 
             rlum[ampname] += [(k, mutset, varset)]
 
+        # bitsets: for each mutation, which of the sets of that amplicon number carry it
+        carriers = {}
+        for ampname, sets in rlum.items():
+            carriers[ampname] = {}
+            for i, (k, mutset, varset) in enumerate(sets):
+                for m in mutset:
+                    carriers[ampname][m] = carriers[ampname].get(m, 0) | (1 << i)
+
         #  now examine each amplicon in succession in search of subsets
         for k1, d in list(amplicons.items()):
             origk1 = k1
@@ -357,30 +2070,30 @@ def make_all_amplicons(amp_bed, vocs, revert=False, n_cooc=2, subset_fix=True):
             if ampname not in rlum:
                 continue
 
+            # the sets carrying all of our mutations
+            supersets = (1 << len(rlum[ampname])) - 1
+            for m in ampmutset:
+                supersets &= carriers[ampname].get(m, 0)
+
             ampmutnum = len(ampmutset)
-            # compare against the whole set (inefficient, but well)
-            for k2, mutset, varset in rlum[ampname]:
-                # skip self
-                if k2 == origk1:
-                    # sanity check
-                    assert (
-                        mutset == ampmutset
-                    ), f"something went wrong while building index: wrong self '{mutset}' vs '{ampmutset}'"
-                    continue
+            # (in the same order as the look-up map)
+            while supersets:
+                bit = supersets & -supersets
+                supersets ^= bit
+                k2, mutset, varset = rlum[ampname][bit.bit_length() - 1]
 
                 # it must be a larger set if we have any chance of being a *sub*set
+                # (this also skips self)
                 if len(mutset) <= ampmutnum:
                     continue
 
-                if 0 == len(ampmutset - mutset):
-                    print(f"{origk1}'s '{ampmutset}' is a subset of {k2}'s '{mutset}'")
+                print(f"{origk1}'s '{ampmutset}' is a subset of {k2}'s '{mutset}'")
 
-                    ampvset = set(k1.split("_")[1:])
+                ampvset = set(k1.split("_")[1:])
 
-                    newk1 = "_".join([ampname] + sorted(list(ampvset.union(varset))))
-                    # only update the label
-                    k1 = newk1
-                    continue
+                newk1 = "_".join([ampname] + sorted(list(ampvset.union(varset))))
+                # only update the label
+                k1 = newk1
 
             # rename the entry using the final label
             if k1 != origk1:
@@ -390,7 +2103,114 @@ def make_all_amplicons(amp_bed, vocs, revert=False, n_cooc=2, subset_fix=True):
     return amplicons
 
 
+def amplicons_hash(amplicons):
+    """content hash of an amplicon query (as made by make_all_amplicons() or load_all_amplicons())"""
+    return hashlib.sha256(
+        json.dumps(
+            [
+                [a] + [int(p) for p in q[:4]] + [[[int(p), m] for p, m in q[4].items()]]
+                for a, q in amplicons.items()
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+# entry of partial results (see --partial) recording the amplicon query
+query_key = "_query"
+
+
+def query_info(amplicons):
+    """summary of the amplicon query recorded in partial results"""
+    return {"hash": amplicons_hash(amplicons), "amplicons": len(amplicons)}
+
+
+def shard_samples(todo, shard):
+    """deterministic partition of a list of samples
+
+    shard: 'I/N', keep the samples of the I-th partition (1-based) out of N.
+    Samples are assigned by a hash of their name, so the partitions do not
+    change when samples are added to or reordered in the list.
+
+    Returns:
+            the samples of the partition, in the same order
+    """
+    m = re.fullmatch(r"(\d+)/(\d+)", shard)
+    assert m, f"Error: --shard must be I/N, got {shard}"
+    (i, n) = (int(m[1]), int(m[2]))
+    assert 1 <= i <= n, f"Error: --shard I/N must have 1 <= I <= N, got {shard}"
+    return [t for t in todo if zlib.crc32(t[0].encode()) % n == i - 1]
+
+
+def amplicon_key(amp):
+    """content hash of a single amplicon definition: its query window and its mutations
+
+    (independent of the label, which changes as variants get merged)
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [int(amp[2]), int(amp[3]), [[int(p), m] for p, m in amp[4].items()]]
+        ).encode()
+    ).hexdigest()
+
+
+# precompiled amplicon queries
+compiled_format = "cojac-amplicons-1"
+
+
+def write_compiled_amplicons(amplicons, outamp):
+    """write an amplicon query as typed arrays in a (uncompressed) numpy .npz file
+
+    Windows and positions are stored as uint32 arrays, labels and mutations
+    as byte strings, with the offsets of each amplicon's mutations and the content
+    hash of the query (see amplicons_hash()).
+    """
+    muts = [(p, m) for q in amplicons.values() for p, m in q[4].items()]
+    with open(outamp, "wb") as nf:
+        np.savez(
+            nf,
+            format=np.array(compiled_format),
+            hash=np.array(amplicons_hash(amplicons)),
+            names=np.array([a.encode() for a in amplicons.keys()], dtype=bytes),
+            windows=np.array(
+                [[int(p) for p in q[:4]] for q in amplicons.values()], dtype=np.uint32
+            ).reshape(-1, 4),
+            offsets=np.cumsum(
+                [0] + [len(q[4]) for q in amplicons.values()], dtype=np.uint32
+            ),
+            positions=np.array([int(p) for p, m in muts], dtype=np.uint32),
+            bases=np.array([m.encode() for p, m in muts], dtype=bytes),
+        )
+
+
+def load_compiled_amplicons(inamp):
+    """load an amplicon query written by write_compiled_amplicons(), checking its content hash"""
+    with np.load(inamp, allow_pickle=False) as nz:
+        assert (
+            str(nz["format"]) == compiled_format
+        ), f"Error: {inamp} is not a precompiled amplicon query ({compiled_format})"
+        (windows, offsets) = (nz["windows"], nz["offsets"])
+        (positions, bases) = (nz["positions"], nz["bases"])
+        amplicons = {
+            a: list(windows[i])
+            + [
+                dict(
+                    zip(
+                        positions[offsets[i] : offsets[i + 1]],
+                        (m.decode() for m in bases[offsets[i] : offsets[i + 1]]),
+                    )
+                )
+            ]
+            for i, a in enumerate(a.decode() for a in nz["names"])
+        }
+        assert amplicons_hash(amplicons) == str(
+            nz["hash"]
+        ), f"Error: content hash mismatch in precompiled amplicon query {inamp}"
+    return amplicons
+
+
 def load_all_amplicons(inamp):
+    if inamp.endswith(".npz"):
+        return load_compiled_amplicons(inamp)
     with open(inamp, "rt") as yf:
         # type: force convert into numpy
         return {
@@ -418,6 +2238,8 @@ def add_name_comments(in_str, amp_bed):
 
 
 def write_all_amplicons(amplicons, outamp, amp_bed=None):
+    if outamp.endswith(".npz"):
+        return write_compiled_amplicons(amplicons, outamp)
     with open(outamp, "wt") as yf:
         # wrapper that force either flow style or block style
         class blockmap(dict):
@@ -495,6 +2317,14 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     type=str,
     help="concatenate samplename/batchname from samples tsv",
 )
+@click.option(
+    "--shard",
+    metavar="I/N",
+    required=False,
+    default=None,
+    type=str,
+    help="only scan the I-th (1-based) of N deterministic partitions of the samples (by hash of their name), e.g.: to dispatch a samples list on a cluster. Implies --partial, combine the results with cooc-merge",
+)
 @click.option(
     "-p",
     "--prefix",
@@ -514,6 +2344,24 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     type=str,
     help="reference to look for in alignment files",
 )
+@click.option(
+    "-T",
+    "--fasta",
+    metavar="FASTA",
+    required=False,
+    default=None,
+    type=str,
+    help="local reference FASTA to decode CRAM alignment files (references are then never fetched remotely)",
+)
+@click.option(
+    "-@",
+    "--threads",
+    metavar="N",
+    required=False,
+    default=1,
+    type=click.IntRange(min=1),
+    help="number of htslib threads to decompress each alignment file (BGZF/CRAM), on top of --jobs",
+)
 @click.option(
     "-m",
     "--vocdir",
@@ -581,7 +2429,7 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     required=False,
     default=None,
     type=str,
-    help="use the supplied YAML file to query amplicons instead of building it from BED + voc's DIR",
+    help="use the supplied YAML file (or precompiled '.npz' file, see -A) to query amplicons instead of building it from BED + voc's DIR",
 )
 @click.option(
     "-A",
@@ -590,9 +2438,9 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     "outamp",
     metavar="YAML",
     required=False,
-    default=None,
+    multiple=True,
     type=str,
-    help="output amplicon query in a YAML file",
+    help="output amplicon query in a YAML file, or precompiled in a binary file if ending in '.npz' (fast to load with -Q, e.g.: for many short jobs). Can be repeated (e.g.: for both), and used with -Q to convert",
 )
 @click.option(
     "--comment/--no-comment",
@@ -620,6 +2468,21 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     type=str,
     help="output results to a yaml file",
 )
+@click.option(
+    "--jsonl",
+    "jsonl_fname",
+    metavar="JSONL",
+    required=False,
+    default=None,
+    type=str,
+    help="output results to a JSON Lines file (gzip-compressed if ending in '.gz'), one sample per line written as soon as it's scanned",
+)
+@click.option(
+    "--partial",
+    is_flag=True,
+    default=False,
+    help=f"also record the hash of the amplicon query in the JSON/YAML (under '{query_key}'), for combining partial results with cooc-merge",
+)
 @click.option(
     "-t",
     "--tsv",
@@ -629,19 +2492,153 @@ def write_all_amplicons(amplicons, outamp, amp_bed=None):
     type=str,
     help="output results to a (raw) tsv file",
 )
+@click.option(
+    "--columnar",
+    "columnar_fname",
+    metavar="PARQUET/ARROW",
+    required=False,
+    default=None,
+    type=str,
+    help="output results to a long-format columnar table (one row per sample and amplicon, with columns: sample, batch, amplicon, cooc, count, mut_all, mut_oneless, frac), as Parquet, or as Arrow IPC if ending in '.arrow' or '.feather' (requires pyarrow)",
+)
 @click.option(
     "-d",
     "--dump",
     is_flag=True,
     help="dump the python object to the terminal",
 )
+@click.option(
+    "-J",
+    "--jobs",
+    metavar="N",
+    required=False,
+    default=1,
+    type=click.IntRange(min=1),
+    help="number of alignment files to scan in parallel, using a pool of processes",
+)
+@click.option(
+    "--cache",
+    "cachedir",
+    metavar="DIR",
+    required=False,
+    default=None,
+    type=str,
+    help="cache the results of each alignment file in this directory, and only scan new or changed alignment files or amplicon definitions (see cooc-cache for statistics)",
+)
+@click.option(
+    "--cache-size",
+    metavar="MB",
+    required=False,
+    default=1024,
+    type=click.IntRange(min=0),
+    help="maximum size of the cache, least recently used results are evicted",
+)
+@click.option(
+    "--journal",
+    metavar="JSONL",
+    required=False,
+    default=None,
+    type=str,
+    help="checkpoint: append the results of each sample to this JSON Lines file as soon as it's scanned, and skip samples already present in it when restarting (with the same amplicon query and options)",
+)
+@click.option(
+    "--profile",
+    "profile_fname",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=str,
+    help="write per-sample and per-amplicon statistics (wall time, reads fetched, pairs evaluated, reads/second, growth of resident memory) and the peak RSS of the run to a JSON file",
+)
+@click.option(
+    "--cprofile",
+    "cprofile_fname",
+    metavar="FILE",
+    required=False,
+    default=None,
+    type=str,
+    help="dump cProfile statistics of the scan (of the main process only, use without --jobs) for pstats or snakeviz",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(list(scan_engines.keys())),
+    default="fetch",
+    help="how to read alignments: 'fetch' each distinct query window with the index (best for few windows, e.g.: up to ~15 of the 98 of ARTIC V3), 'stream' once over all windows (best for more windows), or 'collate' name-collated alignments without index (e.g.: '-a -' for stdin from samtools collate or an aligner)",
+)
+@click.option(
+    "--max-pairs",
+    metavar="N",
+    required=False,
+    default=None,
+    type=click.IntRange(min=1),
+    help="subsample amplicons deeper than N read-pairs covering sites: only use a uniform sample of N pairs (selected by hashing the read names, so mates stay together)",
+)
+@click.option(
+    "--ci-width",
+    metavar="W",
+    required=False,
+    default=None,
+    type=click.FloatRange(min=0.0, max=1.0, min_open=True),
+    help="subsample amplicons: only use the smallest uniform sample of read-pairs for which the 95% confidence interval of the fraction of pairs carrying mutations is narrower than W (e.g.: 0.02). Implies --max-pairs (1.96/W)^2, enough for any fraction, the sample being trimmed down at the end of the window",
+)
+@click.option(
+    "--haplotypes",
+    is_flag=True,
+    default=False,
+    help="also count, per amplicon, every pattern of sites covered and mutations found on the read-pairs (stored in an extra 'haplotypes' entry next to 'sites' and 'muts')",
+)
+@click.option(
+    "--min-reads",
+    metavar="N",
+    required=False,
+    default=None,
+    type=click.IntRange(min=1),
+    help="preflight: count the reads of each amplicon's window using the index, and skip (report as zero coverage) those with fewer than N reads, e.g.: dropouts",
+)
+@click.option(
+    "--explain",
+    is_flag=True,
+    default=False,
+    help="dry run: only read the headers and indexes of the alignment files, and report for each the number of fetches, estimated reads to decode, peak of mates pending pairing and its memory, and projected runtime (with --calibration). With --engine collate, there is no index: the number of reads is extrapolated from the file size (not possible on stdin or CRAM)",
+)
+@click.option(
+    "--calibration",
+    metavar="JSON",
+    required=False,
+    default=None,
+    type=click.Path(exists=True),
+    help="with --explain, project the runtime from the speed measured in this --profile JSON of a previous run",
+)
+@click.option(
+    "--split-by-rg",
+    is_flag=True,
+    default=False,
+    help="demultiplex read-groups: scan each alignment file in a single pass, but output one entry per read-group sample (SM field of the @RG header lines, or ID if missing)",
+)
+@click.option(
+    "--split-tag",
+    metavar="TAG",
+    required=False,
+    default=None,
+    type=str,
+    help="like --split-by-rg, but using the values of any other tag (e.g.: 'BC' for barcodes, or 'CB' for cells) as output entries",
+)
+@click.option(
+    "--split-amplicons",
+    is_flag=True,
+    default=False,
+    help="with --jobs, split the amplicons of each alignment file across the processes (balanced by read depth) instead of scanning multiple alignment files in parallel",
+)
 def cooc_mutbamscan(
     samples,
     alignments,
     name,
     batchname,
+    shard,
     prefix,
     rq_chr,
+    fasta,
+    threads,
     vocdir,
     voc,
     revert,
@@ -654,14 +2651,36 @@ def cooc_mutbamscan(
     comment,
     json_fname,
     yaml_fname,
+    jsonl_fname,
+    partial,
     tsv,
+    columnar_fname,
     dump,
+    jobs,
+    split_amplicons,
+    engine,
+    max_pairs,
+    ci_width,
+    haplotypes,
+    min_reads,
+    explain,
+    calibration,
+    split_by_rg,
+    split_tag,
+    cachedir,
+    cache_size,
+    journal,
+    profile_fname,
+    cprofile_fname,
 ):
     # amplicons that will be searched
     amplicons = {}
     if inamp is not None:
         # load pre-computed amplicons
         amplicons = load_all_amplicons(inamp)
+        # (e.g.: precompile)
+        for out in outamp:
+            write_all_amplicons(amplicons, out)
     else:
         if vocdir:
             if not voc:
@@ -679,15 +2698,15 @@ def cooc_mutbamscan(
             amp_bed, voc, revert=revert, n_cooc=cooc, subset_fix=subset_fix
         )
         # and save them for future reference
-        if outamp:
-            write_all_amplicons(amplicons, outamp, amp_bed if comment else None)
+        for out in outamp:
+            write_all_amplicons(amplicons, out, amp_bed if comment else None)
 
     rq_chr = rq_chr  # e.g.: 'NC_045512.2'
 
+    # list of samples to scan: (output name, alignment file)
+    todo = []
     # loop for if samples are given through the TSV list
-    table = {}
     if samples is not None:
-        i = 0
         with open(
             samples, "rt", encoding="utf-8", newline=""
         ) as tf:  # this file has the same content as the original experiment
@@ -695,9 +2714,9 @@ def cooc_mutbamscan(
                 sample, batch = r[:2]
                 print(sample)
                 alnfname = findbam(prefix, batch, sample)
-                table[f"{sample}{batchname}{batch}" if batchname else sample] = scanbam(
-                    alnfname, amplicons, rq_chr
-                )
+                todo += [
+                    (f"{sample}{batchname}{batch}" if batchname else sample, alnfname)
+                ]
 
     # loop for if samples are given through -a option
     # this option can also de used to dispatch per sample jobx on the cluster
@@ -706,24 +2725,158 @@ def cooc_mutbamscan(
             assert len(alignments) == len(
                 name
             ), f"Error: the number of BAMs/CRAMs files given to the -a/--alignments parameter and the number of NAMEs given to -n/--name must mach.\n{len(alignments)} BAM(s)/CRAM(s) given vs {len(name)} NAMEs"
-        for alnfname, sample in zip(alignments, name if name else alignments):
-            # HACK use the whole BAM file as sample name if no names provided
-            table[sample] = scanbam(alnfname, amplicons, rq_chr)
+        # HACK use the whole BAM file as sample name if no names provided
+        todo = list(zip(name if name else alignments, alignments))
     else:
         # we only wrote out the outamp and have nothing else to do.
         return
 
+    if shard:
+        todo = shard_samples(todo, shard)
+        print(f"shard {shard}: {len(todo)} samples")
+
+    if any(alnfname == "-" for sample, alnfname in todo):
+        assert (
+            engine == "collate"
+        ), "Error: reading alignments from stdin ('-') requires --engine collate"
+        assert not cachedir, "Error: --cache cannot be used with stdin ('-')"
+    if engine == "collate":
+        assert (
+            not split_amplicons
+        ), "Error: --split-amplicons cannot be used with --engine collate (it needs an index)"
+        assert (
+            not min_reads
+        ), "Error: --min-reads cannot be used with --engine collate (it needs an index)"
+
+    # scan (possibly in parallel), results come back in the same order as scan_todo
+    scan_opts = {"engine": engine}
+    if threads > 1:
+        scan_opts["threads"] = threads
+    if fasta:
+        local_reference_only()
+        scan_opts["fasta"] = fasta
+    # (subsampling changes the results: these are part of the cache keys)
+    if max_pairs:
+        scan_opts["max_pairs"] = max_pairs
+    if ci_width:
+        scan_opts["ci_width"] = ci_width
+    if haplotypes:
+        scan_opts["haplotypes"] = True
+    if split_by_rg or split_tag:
+        scan_opts["split_tag"] = split_tag or "RG"
+    if min_reads:
+        scan_opts["min_reads"] = min_reads
+
+    # resume from the samples already in the journal
+    done = {}
+    if journal:
+        done = load_journal(journal, journal_query(amplicons, scan_opts))
+        if len(done):
+            print(f"journal: skipping {len(done)} samples already scanned")
+    scan_todo = [(s, a) for s, a in todo if s not in done]
+
+    if explain:
+        explain_scan(
+            scan_todo,
+            amplicons,
+            rq_chr,
+            jobs=jobs,
+            calibration=calibration,
+            scan_opts=scan_opts,
+        )
+        return
+    profiles = [] if profile_fname else None
+    if cprofile_fname:
+        import cProfile
+
+        cprof = cProfile.Profile()
+        cprof.enable()
+    t_scan = time.perf_counter()
+    if cachedir:
+        cache = ScanCache(cachedir, max_size=cache_size * 1024 * 1024)
+        results = scanbam_cached(
+            [a for s, a in scan_todo],
+            amplicons,
+            rq_chr,
+            cache,
+            jobs=jobs,
+            split_amplicons=split_amplicons,
+            scan_opts=scan_opts,
+            profiles=profiles,
+        )
+    else:
+        results = scanbam_all(
+            [a for s, a in scan_todo],
+            amplicons,
+            rq_chr,
+            jobs=jobs,
+            split_amplicons=split_amplicons,
+            scan_opts=scan_opts,
+            profiles=profiles,
+        )
+    # without other outputs, the JSON Lines are written as they come, and nothing is kept in memory
+    keep = dump or json_fname or yaml_fname or tsv or columnar_fname or not jsonl_fname
+    split = split_by_rg or split_tag
+
+    def stream(jl, sample, result):
+        for name, res in (
+            split_groups(result, sample).items() if split else [(sample, result)]
+        ):
+            append_journal(jl, name, res)
+
+    with open_journal(journal, journal_query(amplicons, scan_opts)) as jf, open_jsonl(
+        jsonl_fname
+    ) as jl:
+        if jl:
+            print(json.dumps({query_key: query_info(amplicons)}), file=jl)
+            # samples from the journal come first
+            for sample, alnfname in todo:
+                if sample in done:
+                    stream(jl, sample, done[sample])
+        for (sample, alnfname), result in zip(scan_todo, results):
+            if keep:
+                done[sample] = result
+            if jf:
+                append_journal(jf, sample, result)
+            if jl:
+                stream(jl, sample, result)
+    if cachedir:
+        print(f"cache: {cache.hits} amplicon hits, {cache.misses} misses")
+        cache.save_stats()
+    t_scan = time.perf_counter() - t_scan
+    if cprofile_fname:
+        cprof.disable()
+        cprof.dump_stats(cprofile_fname)
+    if profile_fname:
+        write_profile(profile_fname, profiles, scan_todo, t_scan)
+    if not keep:
+        return
+
+    if split:
+        # one entry per group, reads without tag are named after the file's sample
+        table = {}
+        for sample, alnfname in todo:
+            for group, res in split_groups(done[sample], sample).items():
+                assert (
+                    group not in table
+                ), f"Error: group {group} found in multiple alignment files (e.g.: {alnfname})"
+                table[group] = res
+    else:
+        table = {sample: done[sample] for sample, alnfname in todo}
+
     #
     # dumps, for being able to take it from here
     #
-    if (dump) or (not (json_fname or yaml_fname)):
+    if (dump) or (not (json_fname or yaml_fname or jsonl_fname or columnar_fname)):
         print(table)
+    # partial results: keep track of the query, to be checked when merging
+    query = {query_key: query_info(amplicons)} if partial or shard else {}
     if json_fname:
         with open(json_fname, "wt") as jf:
-            json.dump(obj=table, fp=jf)
+            json.dump(obj={**query, **table}, fp=jf)
     if yaml_fname:
         with open(yaml_fname, "wt") as yf:
-            print(yaml.dump(table, sort_keys=False), file=yf)
+            print(yaml.dump({**query, **table}, sort_keys=False), file=yf)
 
     # raw data into pands.DataFrame
     if tsv:
@@ -737,6 +2890,8 @@ def cooc_mutbamscan(
         # with pd.option_context('display.max_rows', None): #, 'display.max_columns', None):
         # print(raw_table_df)
         raw_table_df.to_csv(tsv, sep="\t", compression={"method": "infer"})
+    if columnar_fname:
+        write_columnar(columnar_table(table.items(), batchname), columnar_fname)
 
 
 if __name__ == "__main__":
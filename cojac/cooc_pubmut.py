@@ -12,6 +12,13 @@ import gzip
 
 import click
 
+from .cooc_mutbamscan import (
+    columnar_results,
+    iter_jsonl,
+    query_key,
+    read_columnar,
+)
+
 
 @click.command(
     help="Make a pretty table",
@@ -53,6 +60,20 @@ import click
     type=str,
     help="results generated by mutbamscan",
 )
+@click.option(
+    "--jsonl",
+    "jsonl_fname",
+    metavar="JSONL",
+    type=str,
+    help="results generated by mutbamscan --jsonl (read one sample at a time)",
+)
+@click.option(
+    "--columnar",
+    "columnar_fname",
+    metavar="PARQUET/ARROW",
+    type=str,
+    help="results table generated by mutbamscan --columnar or tabmut (Parquet or Arrow IPC)",
+)
 @click.option(
     "-o",
     "--output",
@@ -96,7 +117,17 @@ import click
     help="Run quietly: do not print the table",
 )
 def cooc_pubmut(
-    vocdir, amp, json_fname, yaml_fname, csv_fname, escape, semi, batchname, quiet
+    vocdir,
+    amp,
+    json_fname,
+    yaml_fname,
+    jsonl_fname,
+    columnar_fname,
+    csv_fname,
+    escape,
+    semi,
+    batchname,
+    quiet,
 ):
     escape = (
         ("\\n", csv.QUOTE_NONNUMERIC, "\\")
@@ -181,15 +212,32 @@ def cooc_pubmut(
         assert os.path.isfile(yaml_fname), f"cannot find result json file {yaml_fname}"
         with open(yaml_fname, "rt") as yf:
             table = yaml.safe_load(yf)
+    elif jsonl_fname:
+        assert os.path.isfile(
+            jsonl_fname
+        ), f"cannot find result jsonl file {jsonl_fname}"
+    elif columnar_fname:
+        assert os.path.isfile(
+            columnar_fname
+        ), f"cannot find result table file {columnar_fname}"
 
-    assert len(table) > 0, "cannot succesfully load table"
+    # JSON Lines are read one sample at a time, instead of loading the whole table
+    if jsonl_fname:
+        samples = iter_jsonl(jsonl_fname)
+    elif columnar_fname:
+        samples = columnar_results(read_columnar(columnar_fname), batchname or "/")
+    else:
+        samples = table.items()
 
     #
     # pretty output for article
     #
 
     df_dict = {}
-    for sam, amplicons in table.items():
+    for sam, amplicons in samples:
+        if sam == query_key:
+            # see mutbamscan --partial
+            continue
         print(sam)
         # table key
         ksam = None
@@ -223,6 +271,8 @@ def cooc_pubmut(
                 }
             )
 
+    assert len(df_dict) > 0, "cannot succesfully load table"
+
     pretty_table_df = pd.DataFrame.from_dict(data=df_dict, orient="index")
     # TODO rename column with pretty names. (like in colourmut)
     if not quiet:
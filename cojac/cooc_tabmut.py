@@ -12,6 +12,16 @@ import gzip
 
 import click
 
+from .cooc_mutbamscan import (
+    amplicon_summary,
+    columnar_results,
+    columnar_table,
+    iter_jsonl,
+    query_key,
+    read_columnar,
+    write_columnar,
+)
+
 
 @click.command(help="Make a table suitable for further processing: RStudio, etc")
 # TODO: create mutually exclusive options
@@ -31,6 +41,20 @@ import click
     type=str,
     help="results generated by mutbamscan",
 )
+@click.option(
+    "--jsonl",
+    "jsonl_fname",
+    metavar="JSONL",
+    type=str,
+    help="results generated by mutbamscan --jsonl (read one sample at a time)",
+)
+@click.option(
+    "--columnar",
+    "columnar_fname",
+    metavar="PARQUET/ARROW",
+    type=str,
+    help="results table generated by mutbamscan --columnar or tabmut (Parquet or Arrow IPC)",
+)
 @click.option(
     "--batchname",
     metavar="SEP",
@@ -47,7 +71,7 @@ import click
     required=False,
     default="scanned_table.csv",
     type=str,
-    help="name of (raw) csv file to save the table into",
+    help="name of (raw) csv file to save the table into, or of a long-format columnar table if ending in '.parquet', '.arrow' or '.feather' (requires pyarrow)",
 )
 @click.option(
     "-l",
@@ -90,7 +114,17 @@ import click
     help="Run quietly: do not print the table",
 )
 def cooc_tabmut(
-    json_fname, yaml_fname, batchname, csv_fname, lines, semi, multiindex, amp, quiet
+    json_fname,
+    yaml_fname,
+    jsonl_fname,
+    columnar_fname,
+    batchname,
+    csv_fname,
+    lines,
+    semi,
+    multiindex,
+    amp,
+    quiet,
 ):
     # load amplicons
     amplicon_nfo = {}
@@ -142,8 +176,32 @@ def cooc_tabmut(
         assert os.path.isfile(yaml_fname), f"cannot find result json file {yaml_fname}"
         with open(yaml_fname, "rt") as yf:
             table = yaml.safe_load(yf)
+    elif jsonl_fname:
+        assert os.path.isfile(
+            jsonl_fname
+        ), f"cannot find result jsonl file {jsonl_fname}"
+    elif columnar_fname:
+        assert os.path.isfile(
+            columnar_fname
+        ), f"cannot find result table file {columnar_fname}"
 
-    assert len(table) > 0, "cannot succesfully load table"
+    # JSON Lines are read one sample at a time, instead of loading the whole table
+    if jsonl_fname:
+        samples = iter_jsonl(jsonl_fname)
+    elif columnar_fname:
+        samples = columnar_results(read_columnar(columnar_fname), batchname or "/")
+    else:
+        samples = table.items()
+
+    if csv_fname.endswith((".parquet", ".arrow", ".feather")):
+        # typed columns, no formatting options
+        df = columnar_table(samples, batchname)
+        assert len(df) > 0, "cannot succesfully load table"
+        if not quiet:
+            with pd.option_context("display.max_rows", None):
+                print(df)
+        write_columnar(df, csv_fname)
+        return
 
     #
     # tabluar output for down-stream processing
@@ -154,7 +212,10 @@ def cooc_tabmut(
     else:
         df_dict = {}
     batch = None
-    for sam, amplicons in table.items():
+    for sam, amplicons in samples:
+        if sam == query_key:
+            # see mutbamscan --partial
+            continue
         ksam = None
         if batchname:
             (sam, ignore, batch) = sam.rpartition(batchname)
@@ -170,24 +231,9 @@ def cooc_tabmut(
 
         for ampname, amp in amplicons.items():
             # get topmost
-            sites_cnt_l = -1
-            sites_cnt = 0
-            if amp["sites"]:  # empty ?
-                (sites_cnt_l, sites_cnt) = list(amp["sites"].items())[-1]
-            muts_cnt_l = -1
-            muts_cnt = 0
-            mut_oneless = 0
-            if amp["muts"]:  # empty ?
-                # (muts_cnt_l,muts_cnt)=list(amp['muts'].items())[-1]
-                # if int(muts_cnt_l) < int(sites_cnt_l):
-                # muts_cnt = 0
-                for l, cnt in amp["muts"].items():
-                    if int(l) < 1:
-                        continue
-                    elif int(sites_cnt_l) == int(l):
-                        muts_cnt = int(cnt)
-                    elif int(sites_cnt_l) - 1 == int(l):
-                        mut_oneless = cnt
+            (sites_cnt_l, sites_cnt, muts_cnt, mut_oneless) = amplicon_summary(amp)
+            if sites_cnt_l is None:  # empty ?
+                sites_cnt_l = -1
 
             # pack into dict for pandas
             if lines:
@@ -230,6 +276,8 @@ def cooc_tabmut(
                     }
                 )
 
+    assert len(df_list if lines else df_dict) > 0, "cannot succesfully load table"
+
     if lines:
         rstudio_table_df = pd.DataFrame.from_records(data=df_list)
     else:
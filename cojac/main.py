@@ -3,8 +3,10 @@ from ._version import __version__
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
+from .cooc_cache import cooc_cache
 from .cooc_colourmut import cooc_colourmut
 from .cooc_curate import cooc_curate
+from .cooc_merge import cooc_merge
 from .cooc_mutbamscan import cooc_mutbamscan
 from .cooc_pubmut import cooc_pubmut
 from .cooc_tabmut import cooc_tabmut
@@ -20,8 +22,10 @@ def cli():
     pass
 
 
+cli.add_command(cooc_cache)
 cli.add_command(cooc_colourmut)
 cli.add_command(cooc_curate)
+cli.add_command(cooc_merge)
 cli.add_command(cooc_mutbamscan)
 cli.add_command(cooc_pubmut)
 cli.add_command(cooc_tabmut)
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+pysam = pytest.importorskip("pysam")
+
+
+REF_NAME = "NC_045512.2"
+REF_LEN = 29903
+
+
+def random_reference(length=2000, seed=42):
+    rng = random.Random(seed)
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def write_bam(path, pairs, ref_len=REF_LEN, ref_name=REF_NAME, index=True):
+    """write a coordinate-sorted (and indexed) BAM out of a list of read-pairs
+
+    each pair is a tuple (name, [(start, cigar, sequence), ...]), the first segment being R1
+    """
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": ref_name, "LN": ref_len}],
+    }
+    segments = []
+    for name, mates in pairs:
+        for i, (start, cigar, seq) in enumerate(mates):
+            a = pysam.AlignedSegment()
+            a.query_name = name
+            a.query_sequence = seq
+            a.reference_id = 0
+            a.reference_start = start
+            a.cigarstring = cigar
+            a.mapping_quality = 60
+            a.query_qualities = pysam.qualitystring_to_array("I" * len(seq))
+            if len(mates) > 1:
+                other = mates[1 - i]
+                a.flag = (
+                    0x1 | 0x2 | (0x40 if i == 0 else 0x80) | (0x20 if i == 0 else 0x10)
+                )
+                a.next_reference_id = 0
+                a.next_reference_start = other[0]
+            segments.append(a)
+    segments.sort(key=lambda a: a.reference_start)
+
+    with pysam.AlignmentFile(str(path), "wb", header=header) as out:
+        for a in segments:
+            out.write(a)
+    if index:
+        pysam.index(str(path))
+    return str(path)
+
+
+def mutate(seq, offset, mutations):
+    """apply {1-based position: bases} onto seq starting at 0-based offset"""
+    seq = list(seq)
+    for p, b in mutations.items():
+        for i, c in enumerate(b):
+            if c != "-" and 0 <= p - 1 - offset + i < len(seq):
+                seq[p - 1 - offset + i] = c
+    return "".join(seq)
+
+
+def simple_pairs(ref, n_pairs, start, length, mutations, mut_every=2, prefix="pair"):
+    """generate n_pairs fully-matching overlapping read-pairs, every mut_every carry the mutations"""
+    pairs = []
+    for n in range(n_pairs):
+        seq = ref[start : start + length + 20]
+        if mut_every and n % mut_every == 0:
+            seq = mutate(seq, start, mutations)
+        r1 = (start, f"{length}M", seq[:length])
+        r2 = (start + 20, f"{length}M", seq[20 : 20 + length])
+        pairs.append((f"{prefix}{n}", [r1, r2]))
+    return pairs
+
+
+@pytest.fixture
+def amplicon_bam(tmp_path):
+    """a small BAM with two amplicons and their query"""
+    ref = random_reference()
+    mut1 = {301: "T", 321: "G"}
+    mut2 = {1101: "A", 1131: "C", 1141: "G"}
+    pairs = simple_pairs(ref, 30, 250, 150, mut1, 2, "a") + simple_pairs(
+        ref, 20, 1050, 150, mut2, 4, "b"
+    )
+    amplicons = {
+        "1_foo": [250, 420, 280, 390, mut1],
+        "2_foo_bar": [1050, 1220, 1080, 1190, mut2],
+    }
+    bam = write_bam(tmp_path / "sample.bam", pairs)
+    return bam, amplicons
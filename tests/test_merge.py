@@ -0,0 +1,96 @@
+import json
+
+import yaml
+from click.testing import CliRunner
+
+from cojac.cooc_merge import cooc_merge
+from cojac.cooc_mutbamscan import (
+    cooc_mutbamscan,
+    shard_samples,
+    write_all_amplicons,
+)
+
+
+def test_shard_samples():
+    todo = [(f"sample{n}", f"sample{n}.bam") for n in range(100)]
+    shards = [shard_samples(todo, f"{i}/4") for i in range(1, 5)]
+    # a partition, keeping the order
+    assert sorted(sum(shards, [])) == sorted(todo)
+    assert all(s == sorted(s, key=todo.index) for s in shards)
+    # independent of the rest of the list
+    assert shard_samples(todo[::-1], "2/4") == shards[1][::-1]
+    assert shard_samples(todo[:10], "3/4") == [t for t in shards[2] if t in todo[:10]]
+
+
+def test_merge(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    names = [f"s{n}" for n in range(6)]
+    args = ["-Q", ampfile]
+    for n in names:
+        args += ["-a", bam, "-n", n]
+
+    runner = CliRunner()
+    full = tmp_path / "full.json"
+    assert runner.invoke(cooc_mutbamscan, args + ["-j", str(full)]).exit_code == 0
+    for i, (opt, ext) in enumerate(
+        [("-j", "json"), ("-y", "yaml"), ("--jsonl", "jsonl.gz")], start=1
+    ):
+        part = str(tmp_path / f"part{i}.{ext}")
+        res = runner.invoke(cooc_mutbamscan, args + ["--shard", f"{i}/3", opt, part])
+        assert res.exit_code == 0
+
+    merged = tmp_path / "merged.json"
+    res = runner.invoke(
+        cooc_merge,
+        [
+            "-j",
+            str(merged),
+            str(tmp_path / "part*.json*"),
+            str(tmp_path / "part2.yaml"),
+        ],
+    )
+    assert res.exit_code == 0
+    assert "merged 6 samples" in res.output
+    expected = json.loads(full.read_text())
+    result = json.loads(merged.read_text())
+    assert sorted(result.keys()) == names
+    assert all(result[n] == expected[n] for n in names)
+
+    # results of another amplicon query
+    other = dict(amplicons, **{"3_baz": [1500, 1700, 1520, 1680, {1601: "A"}]})
+    write_all_amplicons(other, ampfile)
+    res = runner.invoke(
+        cooc_mutbamscan,
+        [
+            "-Q",
+            ampfile,
+            "-a",
+            bam,
+            "-n",
+            "x",
+            "--partial",
+            "-y",
+            str(tmp_path / "x.yaml"),
+        ],
+    )
+    assert res.exit_code == 0
+    assert "_query" in yaml.safe_load((tmp_path / "x.yaml").read_text())
+    res = runner.invoke(
+        cooc_merge,
+        [
+            "-y",
+            str(tmp_path / "bad.yaml"),
+            str(tmp_path / "part1.json"),
+            str(tmp_path / "x.yaml"),
+        ],
+    )
+    assert res.exit_code != 0
+    assert "different amplicon query" in str(res.exception)
+
+    # the same sample twice
+    part1 = str(tmp_path / "part1.json")
+    res = runner.invoke(cooc_merge, ["-j", str(tmp_path / "bad.json"), part1, part1])
+    assert res.exit_code != 0
+    assert "found again" in str(res.exception)
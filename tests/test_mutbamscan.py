@@ -0,0 +1,706 @@
+import gzip
+import json
+import shutil
+import subprocess
+import sys
+from collections import Counter
+
+import numpy as np
+import pysam
+import pytest
+
+from click.testing import CliRunner
+
+from cojac.cooc_mutbamscan import (
+    PairAccumulator,
+    append_journal,
+    columnar_results,
+    columnar_table,
+    cooc_mutbamscan,
+    iter_jsonl,
+    journal_query,
+    load_all_amplicons,
+    load_journal,
+    open_journal,
+    write_all_amplicons,
+    balance_amplicons,
+    bed_load,
+    make_all_amplicons,
+    mapped_reads,
+    scanbam,
+    scanbam_all,
+    scanbam_cached,
+    split_groups,
+)
+from cojac.cooc_cache import ScanCache, restore_result
+from cojac.cooc_tabmut import cooc_tabmut
+from cojac.cooc_mutbamscan import test_read as legacy_test_read
+
+from conftest import (
+    REF_LEN,
+    REF_NAME,
+    mutate,
+    random_reference,
+    simple_pairs,
+    write_bam,
+)
+
+
+def test_scanbam(amplicon_bam):
+    bam, amplicons = amplicon_bam
+    res = scanbam(bam, amplicons, None)
+
+    assert list(res.keys()) == ["1_foo", "2_foo_bar"]
+    assert res["1_foo"] == {"sites": {2: 30}, "muts": {2: 15}}
+    assert res["2_foo_bar"] == {"sites": {3: 20}, "muts": {3: 5}}
+
+
+def test_scanbam_all_jobs(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    serial = list(scanbam_all([bam, bam, bam], amplicons, None))
+    parallel = list(scanbam_all([bam, bam, bam], amplicons, None, jobs=2))
+
+    assert serial == parallel
+    assert serial[0] == scanbam(bam, amplicons, None)
+
+
+def test_scanbam_split_amplicons(amplicon_bam):
+    bam, amplicons = amplicon_bam
+    serial = list(scanbam_all([bam], amplicons, None))
+    split = list(scanbam_all([bam], amplicons, None, jobs=2, split_amplicons=True))
+
+    assert serial == split
+    assert list(split[0].keys()) == list(amplicons.keys())
+
+
+def test_balance_amplicons():
+    depths = {"1_a": 10, "2_a": 100, "3_a": 50, "4_a": 45, "5_a": 5}
+    shards = balance_amplicons(depths, 2)
+
+    assert shards == [["2_a", "5_a"], ["1_a", "3_a", "4_a"]]
+    assert balance_amplicons(depths, 10) == [
+        ["2_a"],
+        ["3_a"],
+        ["4_a"],
+        ["1_a"],
+        ["5_a"],
+    ]
+
+    # amplicons sharing a query window stay together, and weigh only once
+    amplicons = {
+        "1_a": [0, 100, 10, 90, {}],
+        "1_b": [0, 100, 10, 90, {}],
+        "2_a": [80, 200, 90, 190, {}],
+        "3_a": [180, 300, 190, 290, {}],
+        "3_b": [180, 300, 190, 290, {}],
+    }
+    depths = {"1_a": 60, "1_b": 60, "2_a": 50, "3_a": 40, "3_b": 40}
+    assert balance_amplicons(depths, 2, amplicons) == [
+        ["1_a", "1_b"],
+        ["2_a", "3_a", "3_b"],
+    ]
+
+
+def legacy_scanamplicon(read_iter, mut_dict):
+    """the former non-streamed pairing, used as reference"""
+    reads = {}
+    for read in read_iter:
+        if read.is_secondary or read.is_supplementary:
+            # (primary alignments only)
+            continue
+        reads.setdefault(read.query_name, {})["R1" if read.is_read1 else "R2"] = read
+    sites = []
+    muts = []
+    for val in reads.values():
+        site_out = set()
+        mut_out = set()
+        for R in val.values():
+            (t_pos, t_read) = legacy_test_read(R, mut_dict)
+            site_out.update(t_pos or [])
+            mut_out.update(t_read or [])
+        if site_out:
+            sites.append(len(site_out))
+            if mut_out:
+                muts.append(len(mut_out))
+    return {
+        "sites": dict(Counter(sorted(sites))),
+        "muts": dict(Counter(sorted(muts))),
+    }
+
+
+def test_scanamplicon_streaming(tmp_path):
+    ref = random_reference()
+    mut = {501: "T", 541: "G", 581: "C"}
+    pairs = []
+    for n in range(200):
+        # staggered pairs, some mates outside of the query window, some singles
+        start = 300 + n
+        seq = mutate(ref[start : start + 400], start, mut) if n % 3 else ref[start:]
+        mates = [(start, "150M", seq[:150])]
+        if n % 7:
+            mate = 700 if n % 5 == 0 else start + 50
+            mates.append((mate, "150M", ref[mate : mate + 150]))
+        pairs.append((f"r{n}", mates))
+    bam = write_bam(tmp_path / "stream.bam", pairs)
+
+    # secondary and supplementary alignments, after their pair is retired
+    with pysam.AlignmentFile(bam, "rb") as inf:
+        header = inf.header
+        reads = list(inf)
+    for n, read in enumerate(list(reads)):
+        if read.is_read1 and n % 4 == 0:
+            extra = pysam.AlignedSegment.from_dict(read.to_dict(), header)
+            extra.flag |= 0x800 if n % 8 else 0x100
+            extra.reference_start = read.reference_start + 200
+            reads.append(extra)
+    reads.sort(key=lambda r: r.reference_start)
+    bam = str(tmp_path / "supplementary.bam")
+    with pysam.AlignmentFile(bam, "wb", header=header) as outf:
+        for read in reads:
+            outf.write(read)
+    pysam.index(bam)
+
+    with pysam.AlignmentFile(bam, "rb") as alnfile:
+        expected = legacy_scanamplicon(alnfile.fetch(REF_NAME, 450, 650), mut)
+        acc = PairAccumulator(mut, 450, 650)
+        for read in alnfile.fetch(REF_NAME, 450, 650):
+            acc.add(read)
+        result = acc.finish()
+
+    assert result == expected
+    # only reads waiting for their mate are kept
+    assert acc.peak_pending <= 60
+
+    # all engines skip them the same way
+    amplicons = {"1_a": [450, 650, 450, 650, mut]}
+    collated = str(tmp_path / "collated.bam")
+    header = header.to_dict()
+    header["HD"]["SO"] = "queryname"
+    with pysam.AlignmentFile(collated, "wb", header=header) as outf:
+        for read in sorted(reads, key=lambda r: (r.query_name, r.is_read2)):
+            outf.write(read)
+    assert (
+        {"1_a": expected}
+        == scanbam(bam, amplicons, None, engine="fetch")
+        == scanbam(bam, amplicons, None, engine="stream")
+        == scanbam(collated, amplicons, None, engine="collate")
+    )
+
+
+def test_scanbam_stream_engine(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    assert scanbam(bam, amplicons, None, engine="stream") == scanbam(
+        bam, amplicons, None
+    )
+
+    # staggered reads, overlapping windows, and windows without any read
+    ref = random_reference()
+    mut = {501: "T", 541: "G", 581: "C", 1001: "A"}
+    pairs = []
+    for n in range(300):
+        start = 300 + 2 * n
+        seq = mutate(ref[start : start + 400], start, mut) if n % 3 else ref[start:]
+        pairs.append(
+            (f"r{n}", [(start, "150M", seq[:150]), (start + 60, "150M", seq[60:210])])
+        )
+    bam = write_bam(tmp_path / "stagger.bam", pairs)
+    amplicons = {
+        "1_a": [400, 700, 450, 650, {501: "T", 541: "G"}],
+        "1_b": [400, 700, 450, 650, {541: "G", 581: "C"}],
+        "2_a": [500, 800, 520, 600, {541: "G", 581: "C"}],
+        "3_a": [900, 1100, 950, 1050, {1001: "A", 1021: "G"}],
+        "4_a": [1500, 1800, 1550, 1750, {1601: "A", 1621: "G"}],
+        "0_a": [100, 300, 150, 250, {201: "A", 221: "G"}],
+    }
+    expected = scanbam(bam, amplicons, None)
+    result = scanbam(bam, amplicons, None, engine="stream")
+    assert result == expected
+    assert list(result.keys()) == list(amplicons.keys())
+
+
+def test_scanbam_cached(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    cache = ScanCache(str(tmp_path / "cache"), max_size=10 * 1024 * 1024)
+
+    first = list(scanbam_cached([bam], amplicons, None, cache))
+    assert (cache.hits, cache.misses) == (0, 2)
+    second = list(scanbam_cached([bam], amplicons, None, cache))
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert first == second == [scanbam(bam, amplicons, None)]
+    assert cache.save_stats() == {"hits": 2, "misses": 2, "evictions": 0}
+
+    # renamed labels map onto the cached definitions, only new ones get scanned
+    renamed = {
+        "1_foo_baz": amplicons["1_foo"],
+        "2_foo_bar": [1050, 1220, 1080, 1190, {1101: "A", 1131: "C"}],
+    }
+    result = list(scanbam_cached([bam], renamed, None, cache))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert result == [scanbam(bam, renamed, None)]
+
+    # least recently used entries get evicted
+    other = str(tmp_path / "other.bam")
+    shutil.copy(bam, other)
+    shutil.copy(f"{bam}.bai", f"{other}.bai")
+    list(scanbam_cached([other], amplicons, None, cache))
+    assert len(cache.entries()) == 2
+    cache.max_size = max(e[1] for e in cache.entries())
+    cache.evict()
+    assert len(cache.entries()) == 1
+
+    # the cache is only listed once per run, after storing all the results
+    listed = []
+    entries = cache.entries
+    cache.entries = lambda: listed.append(1) or entries()
+    cache.max_size = 1
+    changed = {"2_foo": [1050, 1220, 1080, 1190, {1101: "A"}]}
+    list(scanbam_cached([bam, other], changed, None, cache))
+    assert len(listed) == 1
+    assert len(entries()) == 0
+
+
+def test_journal_resume(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    other = str(tmp_path / "other.bam")
+    shutil.copy(bam, other)
+    shutil.copy(f"{bam}.bai", f"{other}.bai")
+    args = ["-Q", ampfile, "-a", bam, "-n", "first", "-a", other, "-n", "second"]
+
+    runner = CliRunner()
+    full = tmp_path / "full.json"
+    assert runner.invoke(cooc_mutbamscan, args + ["-j", str(full)]).exit_code == 0
+
+    # job killed while writing the second sample
+    journal = tmp_path / "journal.jsonl"
+    with open_journal(str(journal), journal_query(amplicons)) as jf:
+        append_journal(jf, "first", scanbam(bam, amplicons, None))
+        jf.write('{"sample": "second", "res')
+    resumed = tmp_path / "resumed.json"
+    res = runner.invoke(
+        cooc_mutbamscan, args + ["--journal", str(journal), "-j", str(resumed)]
+    )
+    assert res.exit_code == 0
+    assert "skipping 1 samples" in res.output
+    assert resumed.read_text() == full.read_text()
+    assert list(load_journal(str(journal)).keys()) == ["first", "second"]
+
+    # restarted with other options changing the results
+    res = runner.invoke(
+        cooc_mutbamscan,
+        args + ["--journal", str(journal), "--max-pairs", "5", "-j", str(resumed)],
+    )
+    assert res.exit_code != 0
+    assert "different amplicon query or different options" in str(res.exception)
+
+
+def test_jsonl_output(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    args = ["-Q", ampfile, "-a", bam, "-n", "first", "-a", bam, "-n", "second"]
+
+    runner = CliRunner()
+    full = tmp_path / "full.json"
+    assert runner.invoke(cooc_mutbamscan, args + ["-j", str(full)]).exit_code == 0
+    jsonl = str(tmp_path / "results.jsonl.gz")
+    res = runner.invoke(cooc_mutbamscan, args + ["--jsonl", jsonl])
+    assert res.exit_code == 0
+    # nothing kept for printing the table
+    assert "'sites'" not in res.output
+
+    records = list(iter_jsonl(jsonl))
+    assert records[0][0] == "_query"
+    expected = {s: restore_result(r) for s, r in json.loads(full.read_text()).items()}
+    assert dict(records[1:]) == expected
+
+    # a job still writing: truncated gzip stream and last line
+    with gzip.open(jsonl, "rb") as gf:
+        data = gf.read()
+    truncated = str(tmp_path / "truncated.jsonl.gz")
+    with open(truncated, "wb") as tf:
+        tf.write(gzip.compress(data[:-10])[:-8])
+    assert [s for s, r in iter_jsonl(truncated)] == ["_query", "first"]
+
+    # the downstream tools give the same table
+    for fname, opt in [(str(full), "-j"), (jsonl, "--jsonl")]:
+        res = runner.invoke(cooc_tabmut, [opt, fname, "-o", f"{fname}.csv", "-q"])
+        assert res.exit_code == 0
+    assert (tmp_path / "full.json.csv").read_text() == open(f"{jsonl}.csv").read()
+
+
+def test_columnar_table():
+    results = {
+        "s1/b1": {
+            "1_foo": {"sites": {1: 3, 2: 30}, "muts": {1: 7, 2: 15}},
+            "2_foo_bar": {"sites": {}, "muts": {}},
+        },
+        "s2/b1": {
+            "1_foo": {"sites": {"2": 10}, "muts": {"1": 4}},
+            "2_foo_bar": {"sites": {"1": 2, "3": 20}, "muts": {"2": 5, "3": 1}},
+        },
+    }
+    df = columnar_table(results.items(), "/")
+    assert list(df["sample"]) == ["s1", "s1", "s2", "s2"]
+    assert list(df["batch"]) == ["b1"] * 4
+    assert df["cooc"].isna().tolist() == [False, True, False, False]
+    assert list(df["mut_all"]) == [15, 0, 0, 1]
+    assert list(df["mut_oneless"]) == [7, 0, 4, 5]
+    assert str(df["amplicon"].dtype) == "category"
+
+    # only the topmost histogram entries are kept
+    assert dict(columnar_results(df, "/")) == {
+        "s1/b1": {
+            "1_foo": {"sites": {2: 30}, "muts": {1: 7, 2: 15}},
+            "2_foo_bar": {"sites": {}, "muts": {}},
+        },
+        "s2/b1": {
+            "1_foo": {"sites": {2: 10}, "muts": {1: 4}},
+            "2_foo_bar": {"sites": {3: 20}, "muts": {2: 5, 3: 1}},
+        },
+    }
+
+
+def test_columnar_output(amplicon_bam, tmp_path):
+    pytest.importorskip("pyarrow")
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    args = ["-Q", ampfile, "-a", bam, "-n", "first", "-a", bam, "-n", "second"]
+
+    runner = CliRunner()
+    full = str(tmp_path / "full.json")
+    for table in ["results.parquet", "results.arrow"]:
+        table = str(tmp_path / table)
+        res = runner.invoke(cooc_mutbamscan, args + ["-j", full, "--columnar", table])
+        assert res.exit_code == 0
+        # the downstream tools give the same table
+        for fname, opt in [(full, "-j"), (table, "--columnar")]:
+            res = runner.invoke(cooc_tabmut, [opt, fname, "-o", f"{fname}.csv", "-q"])
+            assert res.exit_code == 0
+        assert open(f"{full}.csv").read() == open(f"{table}.csv").read()
+
+
+def test_make_all_amplicons(tmp_path):
+    bedfile = tmp_path / "amplicons.bed"
+    bedfile.write_text(
+        "".join(
+            f"{REF_NAME}\t{b}\t{e}\tamp{n}\t1\t+\n"
+            for n, (b, e) in enumerate([(100, 400), (350, 650), (600, 900)], start=1)
+        )
+    )
+    vocs = []
+    for name, muts in [
+        ("b", [150, 200, 700, 750, 800]),
+        ("a", [150, 200, 700, 750]),
+        ("c", [150, 200, 700, 820]),
+    ]:
+        fname = tmp_path / f"{name}.yaml"
+        fname.write_text(
+            "variant:\n  short: "
+            + name
+            + "\nmut:\n"
+            + "".join(f"  {p}: 'A>T'\n" for p in muts)
+        )
+        vocs.append(str(fname))
+
+    amp_bed = bed_load(str(bedfile))
+    # identical amplicons are merged, in order of appearance
+    amplicons = make_all_amplicons(amp_bed, vocs, subset_fix=False)
+    assert list(amplicons.keys()) == ["3_b", "3_a", "1_a_b_c", "3_c"]
+    assert amplicons["1_a_b_c"][:4] == [100, 400, 130, 320]
+    assert amplicons["1_a_b_c"][4] == {150: "T", 200: "T"}
+    # 3_a's mutations are a subset of 3_b's, 3_c's of nothing
+    amplicons = make_all_amplicons(amp_bed, vocs)
+    assert list(amplicons.keys()) == ["3_b", "1_a_b_c", "3_c", "3_a_b"]
+
+
+def test_compiled_amplicons(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    compiled = str(tmp_path / "amplicons.npz")
+
+    runner = CliRunner()
+    # convert
+    assert (
+        runner.invoke(cooc_mutbamscan, ["-Q", ampfile, "-A", compiled]).exit_code == 0
+    )
+    assert load_all_amplicons(compiled) == load_all_amplicons(ampfile)
+    outputs = []
+    for query in [ampfile, compiled]:
+        out = str(tmp_path / f"{query}.json")
+        res = runner.invoke(cooc_mutbamscan, ["-Q", query, "-a", bam, "-j", out])
+        assert res.exit_code == 0
+        outputs.append(open(out).read())
+    assert outputs[0] == outputs[1]
+
+    # tampered with
+    with np.load(compiled) as nz:
+        arrays = dict(nz)
+    arrays["positions"][0] += 1
+    np.savez(compiled, **arrays)
+    with pytest.raises(AssertionError, match="hash mismatch"):
+        load_all_amplicons(compiled)
+
+
+def test_scanbam_profile(amplicon_bam):
+    bam, amplicons = amplicon_bam
+    for engine in ["fetch", "stream"]:
+        profile = {}
+        res = scanbam(bam, amplicons, None, engine=engine, profile=profile)
+        assert res == scanbam(bam, amplicons, None)
+        assert profile["reads_decoded"] == 100
+        assert profile["pairs"] == 50
+        assert profile["amplicons"]["1_foo"]["reads"] == 60
+        assert profile["amplicons"]["2_foo_bar"]["pairs"] == 20
+        assert profile["rss_growth_kb"] is not None
+
+
+def test_scanbam_cram(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    fasta = str(tmp_path / "ref.fasta")
+    with open(fasta, "wt") as ff:
+        print(f">{REF_NAME}\n{random_reference()}{'A' * (REF_LEN - 2000)}", file=ff)
+    pysam.faidx(fasta)
+    cram = str(tmp_path / "sample.cram")
+    with pysam.AlignmentFile(bam, "rb") as inf, pysam.AlignmentFile(
+        cram, "wc", template=inf, reference_filename=fasta
+    ) as outf:
+        for read in inf:
+            outf.write(read)
+    pysam.index(cram)
+
+    expected = scanbam(bam, amplicons, None)
+    assert scanbam(cram, amplicons, None, fasta=fasta, threads=2) == expected
+    assert list(
+        scanbam_all(
+            [cram],
+            amplicons,
+            None,
+            jobs=2,
+            split_amplicons=True,
+            scan_opts={"fasta": fasta, "threads": 2},
+        )
+    ) == [expected]
+
+
+def test_scanbam_subsampling(tmp_path):
+    ref = random_reference()
+    mut = {301: "T", 321: "G"}
+    bam = write_bam(tmp_path / "deep.bam", simple_pairs(ref, 1000, 250, 150, mut, 2))
+    amplicons = {"1_deep": [250, 420, 280, 390, mut]}
+
+    full = scanbam(bam, amplicons, None)
+    assert full == {"1_deep": {"sites": {2: 1000}, "muts": {2: 500}}}
+    # not deep enough: nothing changes
+    assert scanbam(bam, amplicons, None, max_pairs=5000) == full
+
+    for engine in ["fetch", "stream"]:
+        capped = scanbam(bam, amplicons, None, engine=engine, max_pairs=200)["1_deep"]
+        assert capped["subsampled"] == {"pairs": 200, "stop": "max_pairs"}
+        assert capped["sites"] == {2: 200}
+        assert 70 < capped["muts"][2] < 130
+
+        stopped = scanbam(bam, amplicons, None, engine=engine, ci_width=0.2)["1_deep"]
+        assert stopped["subsampled"]["stop"] == "ci_width"
+        assert stopped["sites"][2] == stopped["subsampled"]["pairs"] < 200
+
+    # not deep enough to cap the sample at (1.96/0.2)^2 pairs: only trimmed in the end
+    bam = write_bam(tmp_path / "shallow.bam", simple_pairs(ref, 90, 250, 150, mut, 10))
+    trimmed = scanbam(bam, amplicons, None, ci_width=0.2)["1_deep"]
+    assert trimmed["subsampled"]["stop"] == "ci_width_trim"
+    assert 30 <= trimmed["subsampled"]["pairs"] < 90
+
+    # the order in which pairs complete correlates with their content:
+    # short inserts (mutated) complete before long inserts (wild-type)
+    pairs = simple_pairs(ref, 500, 250, 150, mut, 1, "short")
+    for n in range(500):
+        seq = ref[250:530]
+        pairs.append((f"long{n}", [(250, "150M", seq[:150]), (380, "150M", seq[130:])]))
+    bam = write_bam(tmp_path / "inserts.bam", pairs)
+    assert scanbam(bam, amplicons, None)["1_deep"]["muts"] == {2: 500}
+    for engine in ["fetch", "stream"]:
+        stopped = scanbam(bam, amplicons, None, engine=engine, ci_width=0.1)["1_deep"]
+        assert stopped["subsampled"]["stop"] == "ci_width"
+        assert 0.35 < stopped["muts"][2] / stopped["sites"][2] < 0.65
+
+
+def test_scanbam_haplotypes(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    res = scanbam(bam, amplicons, None, haplotypes=True)
+    expected = scanbam(bam, amplicons, None)
+    assert {a: {k: r[k] for k in ("sites", "muts")} for a, r in res.items()} == expected
+    assert res["1_foo"]["haplotypes"] == {
+        "positions": [301, 321],
+        "patterns": {"11": 15, "00": 15},
+    }
+    assert res["2_foo_bar"]["haplotypes"]["patterns"] == {"000": 15, "111": 5}
+
+    # partial patterns: only one of the mutations, and sites out of reach
+    ref = random_reference()
+    pairs = [
+        (
+            f"r{n}",
+            [(250, "100M", mutate(ref[250:350], 250, {301: "T"} if n % 2 else {}))],
+        )
+        for n in range(10)
+    ]
+    bam = write_bam(tmp_path / "partial.bam", pairs)
+    amplicons = {"1_a": [250, 420, 280, 390, {321: "G", 301: "T", 371: "C"}]}
+    res = scanbam(bam, amplicons, None, engine="stream", haplotypes=True)
+    assert res["1_a"]["haplotypes"] == {
+        "positions": [301, 321, 371],
+        "patterns": {"10.": 5, "00.": 5},
+    }
+
+    # positions loaded with -Q are numpy integers
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    out = str(tmp_path / "haplotypes.json")
+    res = CliRunner().invoke(
+        cooc_mutbamscan, ["-Q", ampfile, "-a", bam, "--haplotypes", "-j", out]
+    )
+    assert res.exit_code == 0, res.output
+    with open(out) as f:
+        assert json.load(f)[bam]["1_a"]["haplotypes"]["positions"] == [301, 321, 371]
+
+
+def test_scanbam_collate_engine(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    expected = scanbam(bam, amplicons, None)
+
+    # name-collated, without index
+    collated = str(tmp_path / "collated.bam")
+    with pysam.AlignmentFile(bam, "rb") as inf:
+        reads = sorted(inf, key=lambda r: (r.query_name, r.is_read2))
+        header = inf.header.to_dict()
+    header["HD"]["SO"] = "queryname"
+    with pysam.AlignmentFile(collated, "wb", header=header) as outf:
+        for read in reads:
+            outf.write(read)
+    assert scanbam(collated, amplicons, None, engine="collate") == expected
+
+    # stdin
+    sam = tmp_path / "collated.sam"
+    pysam.view("-h", "-o", str(sam), collated, catch_stdout=False)
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    out = tmp_path / "out.json"
+    with open(sam, "rb") as stdin:
+        subprocess.run(
+            [sys.executable, "-m", "cojac.cooc_mutbamscan", "-Q", ampfile]
+            + ["-a", "-", "-n", "s", "--engine", "collate", "-j", str(out)],
+            stdin=stdin,
+            check=True,
+        )
+    assert json.loads(out.read_text()) == {
+        "s": {
+            a: {k: {str(c): n for c, n in v.items()} for k, v in r.items()}
+            for a, r in expected.items()
+        }
+    }
+
+
+def test_scanbam_split_by_rg(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    multi = str(tmp_path / "multi.bam")
+    with pysam.AlignmentFile(bam, "rb") as inf:
+        header = inf.header.to_dict()
+        header["RG"] = [
+            {"ID": "lane1", "SM": "A"},
+            {"ID": "lane2", "SM": "A"},
+            {"ID": "lane3", "SM": "B"},
+            {"ID": "lane4", "SM": "C"},
+        ]
+        with pysam.AlignmentFile(multi, "wb", header=header) as outf:
+            for read in inf:
+                # both mutated and non-mutated pairs in each group
+                n = int(read.query_name[1:])
+                read.set_tag("RG", ["lane1", "lane2", "lane3"][n // 2 % 3])
+                outf.write(read)
+    pysam.index(multi)
+
+    for engine in ["fetch", "stream"]:
+        res = scanbam(multi, amplicons, None, engine=engine, split_tag="RG")
+        groups = split_groups(res, "multi")
+        assert list(groups.keys()) == ["A", "B", "C"]
+        assert groups["C"] == {a: {"sites": {}, "muts": {}} for a in amplicons}
+        # groups add up to the whole file
+        for amp_name, full in scanbam(bam, amplicons, None).items():
+            for k in ("sites", "muts"):
+                assert sum(
+                    (Counter(groups[g][amp_name][k]) for g in groups), Counter()
+                ) == Counter(full[k])
+        assert groups["A"]["1_foo"] == {"sites": {2: 20}, "muts": {2: 10}}
+
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    out = tmp_path / "out.json"
+    args = ["-Q", ampfile, "-a", multi, "--split-by-rg", "-j", str(out)]
+    assert CliRunner().invoke(cooc_mutbamscan, args).exit_code == 0
+    assert list(json.loads(out.read_text()).keys()) == ["A", "B", "C"]
+
+
+def test_scanbam_min_reads(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    full = scanbam(bam, amplicons, None)
+    profile = {}
+    res = scanbam(bam, amplicons, None, min_reads=50, profile=profile)
+    assert res == {"1_foo": full["1_foo"], "2_foo_bar": {"sites": {}, "muts": {}}}
+    assert profile["skipped"] == 1
+    assert profile["reads_decoded"] == 60
+
+    # dropout sample: nothing to decode
+    dropout = write_bam(tmp_path / "dropout.bam", [])
+    assert scanbam(dropout, amplicons, None, min_reads=1) == {
+        a: {"sites": {}, "muts": {}} for a in amplicons
+    }
+
+    # heaviest first (from the index statistics), results in the same order
+    assert (mapped_reads(dropout, None), mapped_reads(bam, None)) == (0, 100)
+    assert list(
+        scanbam_all(
+            [dropout, bam, dropout],
+            amplicons,
+            None,
+            jobs=2,
+            scan_opts={"min_reads": 50},
+        )
+    ) == [scanbam(dropout, amplicons, None), res, scanbam(dropout, amplicons, None)]
+
+
+def test_explain(amplicon_bam, tmp_path):
+    bam, amplicons = amplicon_bam
+    ampfile = str(tmp_path / "amplicons.yaml")
+    write_all_amplicons(amplicons, ampfile)
+    profile = str(tmp_path / "profile.json")
+    args = ["-Q", ampfile, "-a", bam, "-n", "s"]
+    runner = CliRunner()
+    assert runner.invoke(cooc_mutbamscan, args + ["--profile", profile]).exit_code == 0
+
+    res = runner.invoke(cooc_mutbamscan, args + ["--explain", "--calibration", profile])
+    assert res.exit_code == 0
+    lines = [l.split("\t") for l in res.stdout.splitlines()]
+    assert lines[0][:3] == ["sample", "fetches", "est_reads"]
+    (sample, fetches, reads, pending, memory, runtime) = lines[1]
+    assert (sample, fetches) == ("s", "2")
+    # 100 reads, spread over the reference by the estimate
+    assert 0 < int(reads) <= 100
+    assert float(runtime) > 0
+    assert "amplicon_" not in res.stdout
+
+    # collated inputs have no index: all the reads get decoded
+    collated = str(tmp_path / "collated.bam")
+    with pysam.AlignmentFile(bam, "rb") as inf:
+        reads = sorted(inf, key=lambda r: (r.query_name, r.is_read2))
+        header = inf.header.to_dict()
+    header["HD"]["SO"] = "queryname"
+    with pysam.AlignmentFile(collated, "wb", header=header) as outf:
+        for read in reads:
+            outf.write(read)
+    args = ["-Q", ampfile, "-a", collated, "-n", "c", "--engine", "collate"]
+    res = runner.invoke(cooc_mutbamscan, args + ["--explain"])
+    assert res.exit_code == 0
+    assert res.stdout.splitlines()[1].split("\t")[:4] == ["c", "0", "100", "0"]
@@ -0,0 +1,72 @@
+import random
+
+import pysam
+
+from cojac.cooc_mutbamscan import test_read as legacy_test_read
+from cojac.cooc_mutbamscan import test_read_cigar as cigar_test_read
+from cojac.cooc_mutbamscan import compile_sites
+
+
+def random_read(rng, ref):
+    """a random read with a CIGAR mixing clips, matches, insertions and (runs of) deletions"""
+    ops = []
+    if rng.random() < 0.3:
+        ops.append((4, rng.randint(1, 10)))  # S
+    ops.append((0, rng.randint(5, 30)))
+    for i in range(rng.randint(0, 6)):
+        ops.append((rng.choice([1, 2, 2, 3, 7, 8]), rng.randint(1, 6)))
+        ops.append((rng.choice([0, 7, 8]), rng.randint(1, 30)))
+    if rng.random() < 0.3:
+        ops.append((4, rng.randint(1, 10)))  # S
+    if rng.random() < 0.1:
+        ops.append((5, rng.randint(1, 10)))  # H
+
+    qlen = sum(l for op, l in ops if op in (0, 1, 4, 7, 8))
+    a = pysam.AlignedSegment()
+    a.query_name = "r"
+    a.query_sequence = "".join(rng.choice("ACGT") for i in range(qlen))
+    a.reference_id = 0
+    a.reference_start = rng.randint(0, 100)
+    a.cigartuples = ops
+    return a
+
+
+def random_mut_dict(rng):
+    muts = {}
+    for i in range(rng.randint(1, 8)):
+        p = rng.randint(1, 260)
+        kind = rng.random()
+        if kind < 0.6:
+            muts[p] = rng.choice("ACGT")
+        elif kind < 0.8:
+            muts[p] = "-" * rng.randint(1, 6)
+        else:
+            muts[p] = "".join(rng.choice("ACGT") for i in range(rng.randint(2, 4)))
+    return dict(sorted(muts.items()))
+
+
+def test_read_cigar_equivalence():
+    rng = random.Random(1234)
+    ref = "".join(rng.choice("ACGT") for i in range(400))
+
+    checked = 0
+    for n in range(3000):
+        read = random_read(rng, ref)
+        mut_dict = random_mut_dict(rng)
+        # also hunt for bases and deletions actually present in the read
+        for p, b in zip(
+            read.get_reference_positions(full_length=True), read.query_sequence
+        ):
+            if p is not None and rng.random() < 0.05:
+                mut_dict[p + 1] = b
+        for start, end in zip(read.get_blocks()[:-1], read.get_blocks()[1:]):
+            if end[0] > start[1] and rng.random() < 0.5:
+                mut_dict[start[1] + 1] = "-" * (end[0] - start[1])
+
+        mut_dict = dict(sorted(mut_dict.items()))
+
+        expected = legacy_test_read(read, mut_dict)
+        assert cigar_test_read(read, compile_sites(mut_dict)) == expected
+        checked += expected[1] is not None
+    # make sure we actually exercised the mutation-found branches
+    assert checked > 100